@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+
+"""
+Incremental deployment of theme and repository resources.
+
+# Author: Tomás Vírseda <tomasvirseda@gmail.com>
+# License: GPLv3
+# Description: Sync resource trees into target/resources using a manifest
+
+Every build deploys the default theme, the active theme, the common
+resources and the repository's own resources into target/resources.
+Those trees rarely change, so the files deployed are recorded in a
+manifest:
+
+    target/resources/.kb4it-manifest.json
+    {"files": {"themes/techdoc/css/kb4it.css": [size, mtime_ns, hash], ...}}
+
+A source file whose size and modification time match its entry is not
+read. When they differ, its hash decides if it really changed (a package
+reinstall touches every file). Files in the manifest that no source
+provides any more are deleted; files KB4IT did not deploy are never
+touched.
+
+With an asset store ('asset_store' in repo.json), deployed files are hard
+links to a content-addressed copy:
+
+    <store>/<hash[:2]>/<hash><extension>
+
+Files that are byte-identical across themes, releases or repositories on
+the same filesystem (UIKit, jQuery, DataTables...) are stored and written
+once, while keeping their usual paths in target/resources. Stored copies
+are read-only; a copy no longer linked from anywhere is deleted. The
+store can be shared by every repository on a host.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+from kb4it.core.log import get_logger
+from kb4it.core.util import replace_with_link, sync_file
+
+MANIFEST_FILE = ".kb4it-manifest.json"
+
+
+def _hash_file(path) -> str:
+    with open(path, "rb") as fin:
+        return hashlib.file_digest(fin, "blake2b").hexdigest()
+
+
+def _unshare(path):
+    """Replace a hard link with a private, writable copy of its file."""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    os.close(fd)
+    shutil.copyfile(path, tmp_path)
+    os.chmod(tmp_path, 0o644)
+    os.replace(tmp_path, path)
+
+
+def _scan(source, prefix, files):
+    """Add the files of a tree to files: relative path -> (path, stat)."""
+    try:
+        entries = list(os.scandir(source))
+    except FileNotFoundError:
+        return
+    for entry in entries:
+        relpath = f"{prefix}/{entry.name}" if prefix else entry.name
+        if entry.is_dir():
+            _scan(entry.path, relpath, files)
+        elif entry.is_file():
+            files[relpath] = (entry.path, entry.stat())
+
+
+class AssetStore:
+    """Content-addressed copies of resource files, shared by hard links."""
+
+    def __init__(self, path):
+        self.log = get_logger("Assets")
+        self.path = os.path.abspath(os.path.expanduser(str(path)))
+        os.makedirs(self.path, exist_ok=True)
+
+    def usable_for(self, target) -> bool:
+        """Return True if stored files can be hard linked into target."""
+        os.makedirs(target, exist_ok=True)
+        return os.stat(self.path).st_dev == os.stat(target).st_dev
+
+    def _blob(self, source, fhash) -> str:
+        extension = os.path.splitext(source)[1]
+        return os.path.join(self.path, fhash[:2], f"{fhash}{extension}")
+
+    def put(self, source, fhash) -> str:
+        """Store a copy of source, unless stored already; return its path."""
+        blob = self._blob(source, fhash)
+        if not os.path.exists(blob):
+            dirname = os.path.dirname(blob)
+            os.makedirs(dirname, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=dirname, suffix=".tmp")
+            os.close(fd)
+            shutil.copyfile(source, tmp_path)
+            # Shared by every link: it must never be written in place
+            os.chmod(tmp_path, 0o444)
+            os.replace(tmp_path, blob)
+        return blob
+
+    def link(self, source, fhash, dest) -> str:
+        """Make dest a hard link to the stored copy of source.
+
+        Return 'skipped' if it already was, 'linked', or whatever
+        util.sync_file returns when it cannot be linked and is copied.
+        """
+        for _ in range(2):
+            blob = self.put(source, fhash)
+            try:
+                if os.path.samefile(blob, dest):
+                    return "skipped"
+            except FileNotFoundError:
+                pass
+            try:
+                if replace_with_link(blob, dest):
+                    return "linked"
+            except FileNotFoundError:
+                # Pruned by a build of another repository meanwhile
+                continue
+            return sync_file(source, dest)
+        raise FileNotFoundError(blob)
+
+    def prune(self) -> int:
+        """Delete the stored copies no longer linked; return how many."""
+        removed = 0
+        for dirpath, _, filenames in os.walk(self.path):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                try:
+                    if os.stat(path).st_nlink == 1:
+                        os.unlink(path)
+                        removed += 1
+                except OSError:
+                    pass
+        self.log.debug(f"[ASSETS] STORE_PRUNED path={self.path} removed={removed}")
+        return removed
+
+
+class AssetManifest:
+    """Resources deployed to a target directory."""
+
+    def __init__(self, target):
+        """Load the manifest of the resources deployed in target."""
+        self.log = get_logger("Assets")
+        self.target = str(target)
+        self.path = os.path.join(self.target, MANIFEST_FILE)
+        try:
+            with open(self.path, "r", encoding="utf-8") as fh:
+                manifest = json.load(fh)
+            self.files = manifest.get("files", {})
+            self.store = manifest.get("store")
+            # Written owner-only by older versions: saved again readable
+            self.changed = os.stat(self.path).st_mode & 0o777 != 0o644
+        except (OSError, ValueError, AttributeError):
+            self.files = {}
+            self.store = None
+            self.changed = False
+
+    def sync(self, trees, mode: str = "copy", changes=None, store=None) -> dict:
+        """Deploy resource trees into the target directory.
+
+        trees is a list of (source directory, path inside target); a
+        file provided by several trees is taken from the last one. mode
+        is a deploy mode (see util.sync_file); with an AssetStore, files
+        are linked from it instead. If changes is a list, (status,
+        relative path) is appended to it for every file added, modified
+        or deleted.
+
+        Return the number of files added, updated, unchanged and deleted.
+        """
+        expected = {}
+        for source, prefix in trees:
+            _scan(str(source), prefix, expected)
+
+        # Files deployed with another store (or none) are linked again
+        store_path = store.path if store is not None else None
+        relink = self.store != store_path
+        previous = self.store if relink else None
+        if relink:
+            self.store = store_path
+            self.changed = True
+
+        stats = {"added": 0, "updated": 0, "unchanged": 0, "deleted": 0}
+        for relpath, (source, st) in expected.items():
+            dest = os.path.join(self.target, relpath)
+            entry = self.files.get(relpath)
+            if (
+                not relink
+                and entry is not None
+                and entry[:2] == [st.st_size, st.st_mtime_ns]
+                and os.path.exists(dest)
+            ):
+                stats["unchanged"] += 1
+                continue
+            fhash = _hash_file(source)
+            if relink or entry is None or entry[2] != fhash or not os.path.exists(dest):
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+                existed = os.path.exists(dest)
+                if store is not None:
+                    action = store.link(source, fhash, dest)
+                else:
+                    if relink and existed and os.stat(dest).st_nlink > 1:
+                        # Linked from the store used before
+                        _unshare(dest)
+                    action = sync_file(source, dest, mode)
+                if action == "skipped":
+                    # Deployed before the manifest existed
+                    stats["unchanged"] += 1
+                else:
+                    stats["added" if entry is None else "updated"] += 1
+                    if changes is not None:
+                        changes.append(("modified" if existed else "added", relpath))
+            else:
+                stats["unchanged"] += 1
+            self.files[relpath] = [st.st_size, st.st_mtime_ns, fhash]
+            self.changed = True
+
+        for relpath in [relpath for relpath in self.files if relpath not in expected]:
+            del self.files[relpath]
+            self.changed = True
+            try:
+                os.unlink(os.path.join(self.target, relpath))
+                stats["deleted"] += 1
+                if changes is not None:
+                    changes.append(("deleted", relpath))
+            except FileNotFoundError:
+                pass
+            self._remove_empty_dirs(os.path.dirname(relpath))
+
+        if self.changed:
+            existed = os.path.exists(self.path)
+            self.save()
+            if changes is not None:
+                changes.append(("modified" if existed else "added", MANIFEST_FILE))
+        if store is not None and (stats["updated"] or stats["deleted"]):
+            store.prune()
+        if previous is not None and os.path.isdir(previous):
+            # Its copies are not linked from here any more
+            AssetStore(previous).prune()
+        return stats
+
+    def _remove_empty_dirs(self, reldir):
+        """Delete a directory left empty, and its empty parents."""
+        while reldir:
+            try:
+                os.rmdir(os.path.join(self.target, reldir))
+            except OSError:
+                return
+            reldir = os.path.dirname(reldir)
+
+    def save(self):
+        """Write the manifest.
+
+        It is replaced, not written in place: in release mode it may be
+        a hard link to the previous release's manifest.
+        """
+        os.makedirs(self.target, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.target, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as fh:
+            json.dump({"files": self.files, "store": self.store}, fh, sort_keys=True)
+        # Published with the website
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, self.path)
+        self.changed = False
+        self.log.debug(f"[ASSETS] MANIFEST_SAVED path={self.path} files={len(self.files)}")
@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+
+"""
+Build daemon used by 'kb4it serve-builds' and 'kb4it build --via-daemon'.
+
+# Author: Tomás Vírseda <tomasvirseda@gmail.com>
+# License: GPLv3
+# Description: Keep warm KB4IT instances and build repositories on request
+
+The daemon listens on a Unix socket and keeps one KB4IT instance per
+repository config file, so a build skips interpreter startup, theme
+loading, template compilation and kbdict loading. Requests are served one
+at a time (builds are never concurrent).
+
+Protocol: newline-delimited JSON. The client sends one request:
+
+    {"action": "build", "config": "/abs/path/repo.json",
+     "force": false, "verify_hashes": false, "export_delta": null,
+     "log_level": "INFO"}
+
+and the daemon answers with any number of log lines followed by the
+result:
+
+    {"log": "<formatted log record>"}
+    {"status": "ok", "summary": {...}}
+    {"status": "error", "reason": "..."}
+"""
+
+import argparse
+import json
+import logging
+import os
+import signal
+import socket
+import socketserver
+
+from kb4it.core.exceptions import KB4ITError
+from kb4it.core.log import get_formatter, get_logger
+
+LOG_LEVELS = ("DEBUG", "INFO", "WARNING", "ERROR")
+
+
+class _ClientLogHandler(logging.Handler):
+    """Send log records to the client connection while a build runs."""
+
+    def __init__(self, wfile, level):
+        super().__init__(level)
+        self.wfile = wfile
+        self.connected = True
+        self.setFormatter(get_formatter())
+
+    def emit(self, record):
+        if not self.connected:
+            return
+        try:
+            send_message(self.wfile, {"log": self.format(record)})
+        except OSError:
+            # Client went away; the build goes on
+            self.connected = False
+
+
+def send_message(wfile, message: dict):
+    """Write a protocol message."""
+    wfile.write(json.dumps(message, ensure_ascii=False).encode("utf-8") + b"\n")
+    wfile.flush()
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+        except ValueError as error:
+            send_message(self.wfile, {"status": "error", "reason": f"invalid request: {error}"})
+            return
+        self.server.daemon.handle_request(request, self.wfile)
+
+
+class _Server(socketserver.UnixStreamServer):
+    def __init__(self, path, daemon):
+        self.daemon = daemon
+        super().__init__(path, _RequestHandler)
+
+
+class _Instance:
+    """A warm KB4IT application for one repository."""
+
+    def __init__(self, app, config_mtime):
+        self.app = app
+        self.config_mtime = config_mtime
+        self.builds = 0
+
+
+class BuildDaemon:
+    """Serve build requests over a Unix socket."""
+
+    def __init__(self, socket_path: str, app_factory):
+        """Set up the daemon.
+
+        app_factory builds a KB4IT application from argparse params.
+        """
+        self.log = get_logger("Daemon")
+        self.socket_path = socket_path
+        self.app_factory = app_factory
+        self.instances = {}
+
+    def serve(self):
+        """Listen for build requests until interrupted."""
+        self._remove_stale_socket()
+        server = _Server(self.socket_path, self)
+        os.chmod(self.socket_path, 0o600)
+        previous = signal.signal(signal.SIGTERM, _terminate)
+        self.log.info(f"[DAEMON] LISTEN socket={self.socket_path}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            self.log.info("[DAEMON] STOP")
+        finally:
+            signal.signal(signal.SIGTERM, previous)
+            server.server_close()
+            try:
+                os.unlink(self.socket_path)
+            except FileNotFoundError:
+                pass
+            for config in list(self.instances):
+                self._drop(config)
+
+    def _remove_stale_socket(self):
+        """Delete a socket left by a daemon that did not exit cleanly."""
+        if not os.path.exists(self.socket_path):
+            os.makedirs(os.path.dirname(self.socket_path), exist_ok=True)
+            return
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(self.socket_path)
+        except OSError:
+            os.unlink(self.socket_path)
+            self.log.debug(f"[DAEMON] STALE_SOCKET_REMOVED path={self.socket_path}")
+        else:
+            raise KB4ITError(f"A build daemon is already listening on {self.socket_path}")
+        finally:
+            probe.close()
+
+    def handle_request(self, request: dict, wfile):
+        """Run a build request and stream its log to the client."""
+        if request.get("action") != "build" or not request.get("config"):
+            send_message(wfile, {"status": "error", "reason": "unsupported request"})
+            return
+        config = os.path.realpath(request["config"])
+        level = request.get("log_level") if request.get("log_level") in LOG_LEVELS else "INFO"
+        handler = _ClientLogHandler(wfile, getattr(logging, level))
+        root = logging.getLogger()
+        root.addHandler(handler)
+        self.log.info(f"[DAEMON] REQUEST config={config} force={bool(request.get('force'))}")
+        try:
+            summary = self._build(config, request)
+        except (Exception, SystemExit) as error:
+            # The instance state is unknown after a failure: start afresh
+            # next time. The daemon itself keeps serving.
+            reason = str(error) if isinstance(error, (KB4ITError, OSError)) else repr(error)
+            self.log.error(f"[DAEMON] BUILD_FAIL config={config} reason={reason}")
+            self._drop(config)
+            result = {"status": "error", "reason": reason}
+        else:
+            result = {"status": "ok", "summary": summary}
+        finally:
+            root.removeHandler(handler)
+        if handler.connected:
+            try:
+                send_message(wfile, result)
+            except OSError:
+                pass
+
+    def _build(self, config: str, request: dict) -> dict:
+        """Build a repository, reusing its warm instance if possible."""
+        config_mtime = os.stat(config).st_mtime_ns
+        instance = self.instances.get(config)
+        if instance is not None and (request.get("force") or instance.config_mtime != config_mtime):
+            # A forced build starts from scratch and a new config may
+            # change anything (theme, paths), so start a new instance
+            self._drop(config)
+            instance = None
+
+        if instance is None:
+            params = argparse.Namespace(
+                action="build",
+                config=config,
+                force=bool(request.get("force")),
+                verify_hashes=bool(request.get("verify_hashes")),
+                export_delta=request.get("export_delta"),
+                log_level="INFO",
+            )
+            instance = _Instance(self.app_factory(params), config_mtime)
+            self.instances[config] = instance
+            self.log.debug(f"[DAEMON] INSTANCE_NEW config={config}")
+        else:
+            backend = instance.app.get_service("Backend")
+            backend.reset_build()
+            instance.app.get_params()["verify_hashes"] = bool(request.get("verify_hashes"))
+            instance.app.get_params()["export_delta"] = request.get("export_delta")
+            self.log.debug(f"[DAEMON] INSTANCE_REUSE config={config} builds={instance.builds}")
+
+        summary = instance.app.get_service("Workflow").build_website()
+        instance.builds += 1
+        return summary
+
+    def _drop(self, config: str):
+        """Stop and forget the instance of a repository."""
+        instance = self.instances.pop(config, None)
+        if instance is None:
+            return
+        for name in list(instance.app.get_services()):
+            try:
+                instance.app.deregister_service(name)
+            except Exception as error:
+                self.log.debug(f"[DAEMON] SERVICE_END_FAIL name={name} reason={error}")
+
+
+def _terminate(signum, frame):
+    raise KeyboardInterrupt
+
+
+def request_build(socket_path: str, request: dict, log_stream) -> dict:
+    """Send a build request to a running daemon.
+
+    Log lines are written to log_stream as they arrive. Return the final
+    result message.
+    """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path)
+    except OSError as error:
+        client.close()
+        raise KB4ITError(f"No build daemon listening on {socket_path} ({error.strerror})") from error
+    with client, client.makefile("rwb") as stream:
+        send_message(stream, request)
+        for line in stream:
+            message = json.loads(line)
+            if "log" in message:
+                print(message["log"], file=log_stream, flush=True)
+            else:
+                return message
+    return {"status": "error", "reason": "connection closed by the daemon"}
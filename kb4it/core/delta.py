@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+
+"""
+Changes made to the website by a build.
+
+# Author: Tomás Vírseda <tomasvirseda@gmail.com>
+# License: GPLv3
+# Description: Per-build change manifest and delta bundle export
+
+The Deployer records every path it adds, modifies or deletes in the
+target directory. At the end of the build the list is saved as
+
+    target/.kb4it-changes.json
+    {"build": "2026-10-18 10:33:12",
+     "added": {"doc0001.html": <blake2b>, ...},
+     "modified": {"index.html": <blake2b>, ...},
+     "deleted": ["doc0020.html", ...]}
+
+and, with 'kb4it build --export-delta out.tar', the changed files and the
+manifest are written to a tarball. Another host applies it by extracting
+the tarball over its copy of the site and deleting the paths listed in
+"deleted" (and the directories they leave empty), without comparing
+trees.
+"""
+
+import hashlib
+import json
+import os
+import tarfile
+import tempfile
+
+from kb4it.core.log import get_logger
+
+CHANGES_FILE = ".kb4it-changes.json"
+
+# Tarball compression by file name suffix
+_TAR_MODES = ((".tar.gz", "w:gz"), (".tgz", "w:gz"), (".tar.bz2", "w:bz2"), (".tar.xz", "w:xz"))
+
+
+class DeployDelta:
+    """Paths changed in a target directory by a deployment."""
+
+    def __init__(self, build: str):
+        self.log = get_logger("Delta")
+        self.build = build
+        self.changes = {}  # relative path -> "added", "modified" or "deleted"
+
+    def record(self, status: str, relpath: str):
+        """Record a change, relative to the target directory."""
+        previous = self.changes.get(relpath)
+        if previous == "deleted" and status != "deleted":
+            status = "modified"
+        elif previous == "added" and status == "modified":
+            status = "added"
+        elif previous == "added" and status == "deleted":
+            # Created and removed in the same build
+            del self.changes[relpath]
+            return
+        self.changes[relpath] = status
+
+    def count(self, status: str) -> int:
+        """Return the number of changes with a given status."""
+        return sum(1 for value in self.changes.values() if value == status)
+
+    def to_dict(self, root) -> dict:
+        """Return the change manifest; hashes are read from root."""
+        manifest = {"build": self.build, "added": {}, "modified": {}, "deleted": []}
+        for relpath, status in sorted(self.changes.items()):
+            if status == "deleted":
+                manifest["deleted"].append(relpath)
+                continue
+            with open(os.path.join(root, relpath), "rb") as fin:
+                manifest[status][relpath] = hashlib.file_digest(fin, "blake2b").hexdigest()
+        return manifest
+
+    def save(self, root):
+        """Write the change manifest into root and return its path.
+
+        It is replaced, not written in place: in release mode it may be
+        a hard link to the previous release's manifest.
+        """
+        path = os.path.join(root, CHANGES_FILE)
+        fd, tmp_path = tempfile.mkstemp(dir=root, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as fh:
+            json.dump(self.to_dict(root), fh, indent=4, sort_keys=True)
+        # Published with the website
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+        self.log.debug(
+            f"[DELTA] SAVED path={path} added={self.count('added')}"
+            f" modified={self.count('modified')} deleted={self.count('deleted')}"
+        )
+        return path
+
+    def export(self, root, filename):
+        """Write the changed files of root and the manifest to a tarball.
+
+        The compression is chosen from the file name (.tar.gz, .tgz,
+        .tar.bz2, .tar.xz); any other name gives a plain tarball.
+        """
+        filename = os.path.abspath(filename)
+        mode = next((mode for suffix, mode in _TAR_MODES if filename.endswith(suffix)), "w")
+        members = [relpath for relpath, status in sorted(self.changes.items()) if status != "deleted"]
+        dirname = os.path.dirname(filename)
+        os.makedirs(dirname, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=dirname, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as fh, tarfile.open(fileobj=fh, mode=mode) as tar:
+                for relpath in members:
+                    tar.add(os.path.join(root, relpath), arcname=relpath, recursive=False)
+                tar.add(os.path.join(root, CHANGES_FILE), arcname=CHANGES_FILE)
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, filename)
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except FileNotFoundError:
+                pass
+            raise
+        self.log.info(f"[DELTA] EXPORTED path={filename} files={len(members)}")
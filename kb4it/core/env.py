@@ -123,6 +123,8 @@ ENV["LPATH"]["ROOT"] = os.path.join(
 )
 ENV["LPATH"]["VAR"] = os.path.join(ENV["LPATH"]["ROOT"], "var")
 ENV["LPATH"]["LOG"] = os.path.join(ENV["LPATH"]["VAR"], "log")
+ENV["LPATH"]["CACHE"] = os.path.join(ENV["LPATH"]["VAR"], "cache")
+ENV["LPATH"]["TEMPLATES"] = os.path.join(ENV["LPATH"]["CACHE"], "templates")
 ENV["LPATH"]["OPT"] = os.path.join(ENV["LPATH"]["ROOT"], "opt")
 ENV["LPATH"]["RESOURCES"] = os.path.join(ENV["LPATH"]["OPT"], "resources")
 ENV["LPATH"]["THEMES"] = os.path.join(ENV["LPATH"]["RESOURCES"], "themes")
@@ -149,5 +151,8 @@ ENV["FILE"]["LOG"] = os.path.join(
 ENV["FILE"]["LOCK"] = os.path.join(
     ENV["LPATH"]["VAR"], f"{ENV['APP']['shortname'].lower()}.lock"
 )
+ENV["FILE"]["SOCKET"] = os.path.join(
+    ENV["LPATH"]["VAR"], f"{ENV['APP']['shortname'].lower()}.sock"
+)
 
 ENV.freeze()
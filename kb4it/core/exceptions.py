@@ -22,3 +22,7 @@ class ThemeError(KB4ITError):
 
 class CompilationError(KB4ITError):
     """A document or key/value page failed to compile."""
+
+
+class DeployError(KB4ITError):
+    """The website could not be deployed to the target directory."""
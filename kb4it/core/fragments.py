@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+
+"""
+Cache of compiled Markdown fragments.
+
+# Author: Tomás Vírseda <tomasvirseda@gmail.com>
+# License: GPLv3
+# Description: Content-addressed store of HTML fragments (var/fragments)
+
+A fragment is the HTML python-markdown produces for a document body,
+TOC and theme markup included. It only depends on the text compiled and
+on the compiler setup (KB4IT and python-markdown versions, extensions,
+theme transformation pairs), so it is stored under a hash of both:
+
+    var/fragments/<key>.html
+    var/fragments/index.json   {"fingerprint": ..., "documents": {docId: key}}
+
+Documents whose metadata changed, or that were renamed or duplicated,
+find their fragment and skip python-markdown. The index tells which
+fragments are still used by some document; the others are deleted at the
+end of the build.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+from kb4it.core.log import get_logger
+
+INDEX_FILE = "index.json"
+
+
+class FragmentCache:
+    """Compiled fragments stored by content hash."""
+
+    def __init__(self, path, fingerprint: str):
+        """Open the cache in path for a compiler setup fingerprint.
+
+        If the fingerprint differs from the stored one, every fragment is
+        stale and the cache is emptied.
+        """
+        self.log = get_logger("Fragments")
+        self.path = str(path)
+        self.fingerprint = fingerprint
+        self.lock = threading.Lock()
+        self.documents = {}
+        self.changed = False
+        self.hits = 0
+        os.makedirs(self.path, exist_ok=True)
+        try:
+            with open(os.path.join(self.path, INDEX_FILE), "r", encoding="utf-8") as fh:
+                index = json.load(fh)
+        except (OSError, ValueError):
+            index = {}
+        if index.get("fingerprint") == fingerprint:
+            self.documents = index.get("documents", {})
+        elif index:
+            self.log.debug("[FRAGMENTS] RESET reason=fingerprint_changed")
+            self.changed = True
+
+    def key(self, text: str) -> str:
+        """Return the key of the fragment compiled from text."""
+        digest = hashlib.blake2b(self.fingerprint.encode("utf-8"))
+        digest.update(text.encode("utf-8"))
+        return digest.hexdigest()
+
+    def _filepath(self, key: str) -> str:
+        return os.path.join(self.path, f"{key}.html")
+
+    def has(self, key: str) -> bool:
+        """Return True if a fragment is stored for key."""
+        return os.path.exists(self._filepath(key))
+
+    def get(self, docId: str, key: str) -> str | None:
+        """Return the stored fragment for key, or None."""
+        try:
+            with open(self._filepath(key), "r", encoding="utf-8") as fh:
+                fragment = fh.read()
+        except OSError:
+            return None
+        self.record(docId, key)
+        with self.lock:
+            self.hits += 1
+        return fragment
+
+    def put(self, docId: str, key: str, fragment: str):
+        """Store the fragment compiled for a document."""
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+            with os.fdopen(fd, "w", encoding="utf-8") as fh:
+                fh.write(fragment)
+            os.replace(tmp_path, self._filepath(key))
+        except OSError as error:
+            self.log.warning(f"[FRAGMENTS] WRITE_FAIL doc={docId} reason={error}")
+            return
+        self.record(docId, key)
+
+    def record(self, docId: str, key: str):
+        """Remember which fragment a document uses."""
+        with self.lock:
+            if self.documents.get(docId) != key:
+                self.documents[docId] = key
+                self.changed = True
+
+    def prune(self, docIds):
+        """Forget documents not in docIds and delete unused fragments."""
+        docIds = set(docIds)
+        for docId in [docId for docId in self.documents if docId not in docIds]:
+            del self.documents[docId]
+            self.changed = True
+        used = {f"{key}.html" for key in self.documents.values()}
+        removed = 0
+        with os.scandir(self.path) as entries:
+            for entry in entries:
+                if entry.name == INDEX_FILE or entry.name in used:
+                    continue
+                try:
+                    os.unlink(entry.path)
+                    removed += 1
+                except OSError:
+                    pass
+        if self.changed:
+            index = {"fingerprint": self.fingerprint, "documents": self.documents}
+            fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+            with os.fdopen(fd, "w", encoding="utf-8") as fh:
+                json.dump(index, fh, sort_keys=True)
+            os.replace(tmp_path, os.path.join(self.path, INDEX_FILE))
+            self.changed = False
+        self.log.debug(f"[FRAGMENTS] PRUNED removed={removed} kept={len(used)} hits={self.hits}")
@@ -34,7 +34,7 @@ def setup_logging(level: str = "INFO", logfile: str | None = None):
     if root.handlers:
         return  # Already configured
 
-    formatter = logging.Formatter(_PATTERN, datefmt=_DATEFMT)
+    formatter = get_formatter()
 
     # Console handler
     console = logging.StreamHandler()
@@ -48,6 +48,11 @@ def setup_logging(level: str = "INFO", logfile: str | None = None):
     root.addHandler(file_handler)
 
 
+def get_formatter() -> logging.Formatter:
+    """Return the formatter used by all KB4IT log handlers."""
+    return logging.Formatter(_PATTERN, datefmt=_DATEFMT)
+
+
 def get_logger(name: str) -> logging.Logger:
     """Return a named logger."""
     return logging.getLogger(name)
@@ -56,7 +61,7 @@ def get_logger(name: str) -> logging.Logger:
 def redirect_logs(logfile: str):
     """Redirect logging to a new file at runtime."""
     root = logging.getLogger()
-    formatter = logging.Formatter(_PATTERN, datefmt=_DATEFMT)
+    formatter = get_formatter()
 
     # Remove only existing FileHandlers
     for handler in root.handlers[:]:
@@ -14,6 +14,7 @@ import os
 import sys
 import uuid
 
+from kb4it.core.daemon import request_build
 from kb4it.core.env import ENV
 from kb4it.core.exceptions import KB4ITError, CompilationError, ConfigError, ThemeError
 from kb4it.core.log import get_logger, setup_logging
@@ -167,11 +168,18 @@ class KB4IT:
         try:
             workflow = self.get_service("Workflow")
             if action == "themes":
-                workflow.list_themes()
+                if self.params.get("command") == "precompile":
+                    workflow.precompile_themes(self.params.get("theme"))
+                else:
+                    workflow.list_themes()
             elif action == "create":
                 workflow.create_repository()
             elif action == "build":
                 workflow.build_website()
+            elif action == "watch":
+                workflow.watch_website()
+            elif action == "serve-builds":
+                workflow.serve_builds()
             elif action == "info":
                 workflow.info_repository()
             elif action == "apps":
@@ -204,12 +212,35 @@ class KB4IT:
         sys.exit(1 if error else 0)
 
 
+def _build_via_daemon(params: argparse.Namespace):
+    """Ask a running build daemon to build the repository and exit."""
+    request = {
+        "action": "build",
+        "config": os.path.abspath(params.config),
+        "force": params.force,
+        "verify_hashes": params.verify_hashes,
+        "export_delta": os.path.abspath(params.export_delta) if params.export_delta else None,
+        "log_level": params.log_level,
+    }
+    socket_path = params.socket or ENV["FILE"]["SOCKET"]
+    try:
+        result = request_build(socket_path, request, sys.stderr)
+    except KB4ITError as error:
+        print(error, file=sys.stderr)
+        print("Start it with 'kb4it serve-builds' or build without --via-daemon.", file=sys.stderr)
+        sys.exit(1)
+    if result.get("status") != "ok":
+        print(f"Build failed: {result.get('reason')}", file=sys.stderr)
+        sys.exit(1)
+    summary = result.get("summary") or {}
+    print(" ".join(f"{key}={value}" for key, value in summary.items()))
+
+
 def main():
     """Set up application arguments and execute."""
-    _acquire_process_lock()
-
     # When called with no arguments in an interactive terminal, launch the TUI
     if len(sys.argv) == 1 and sys.stdin.isatty() and sys.stdout.isatty():
+        _acquire_process_lock()
         try:
             from kb4it.tui.app import run as run_tui
             run_tui()
@@ -261,7 +292,22 @@ def main():
     init_parser.add_argument("repo_path", help="Path to the repository")
 
     # List themes
-    subparsers.add_parser("themes", help="List all installed themes")
+    themes = subparsers.add_parser(
+        "themes",
+        help="List all installed themes",
+        description="List all installed themes, or precompile their templates",
+        epilog="Examples:\n\n"
+        "   kb4it themes\n"
+        "   kb4it themes precompile techdoc",
+    )
+    themes.add_argument(
+        "command",
+        nargs="?",
+        choices=["list", "precompile"],
+        default="list",
+        help="'precompile' compiles the templates of all themes (or the given one) into the template cache",
+    )
+    themes.add_argument("theme", nargs="?", default=None, help="Theme to precompile (default: all)")
 
     # List apps for a specific theme
     theme_apps = subparsers.add_parser(
@@ -287,6 +333,68 @@ def main():
         default=False,
         help="Force recompilation of all documents, ignoring content hashes",
     )
+    repo_build.add_argument(
+        "--verify-hashes",
+        action="store_true",
+        default=False,
+        help="Read and hash every source, even if its size and mtime are unchanged",
+    )
+    repo_build.add_argument(
+        "--export-delta",
+        metavar="TARBALL",
+        default=None,
+        help="Write the files changed by this build, and the list of deleted ones, to a tarball (.tar, .tar.gz, .tar.xz)",
+    )
+    repo_build.add_argument(
+        "--via-daemon",
+        action="store_true",
+        default=False,
+        help="Send the build to a running 'kb4it serve-builds' daemon",
+    )
+    repo_build.add_argument(
+        "--socket",
+        default=None,
+        help=f"Build daemon socket (default: {ENV['FILE']['SOCKET']})",
+    )
+
+    # Watch repository and rebuild on changes
+    repo_watch = subparsers.add_parser(
+        "watch",
+        help="Build a repository and rebuild it whenever its sources change",
+        description="Build the website, then keep running and rebuild only what changed",
+        epilog="Example:\n\n"
+        "   kb4it watch /home/jsmith/Documents/myrepo/config/repo.json",
+    )
+    repo_watch.add_argument(
+        "config", help="Path to the repository config file (mandatory)"
+    )
+    repo_watch.add_argument(
+        "-f", "--force",
+        action="store_true",
+        default=False,
+        help="Force recompilation of all documents in the first build",
+    )
+    repo_watch.add_argument(
+        "--debounce",
+        type=float,
+        default=0.5,
+        help="Seconds the sources must stay unchanged before rebuilding (default: 0.5)",
+    )
+
+    # Build daemon
+    serve_builds = subparsers.add_parser(
+        "serve-builds",
+        help="Run a build daemon for 'kb4it build --via-daemon'",
+        description="Keep repositories loaded in memory and build them on request",
+        epilog="Example:\n\n"
+        "   kb4it serve-builds &\n"
+        "   kb4it build --via-daemon /home/jsmith/Documents/myrepo/config/repo.json",
+    )
+    serve_builds.add_argument(
+        "--socket",
+        default=None,
+        help=f"Unix socket to listen on (default: {ENV['FILE']['SOCKET']})",
+    )
 
     # Get repository info
     repo_info = subparsers.add_parser(
@@ -304,6 +412,11 @@ def main():
     # Dispatch to the appropriate action handler
     try:
         params = parser.parse_args()
+        if params.action == "build" and params.via_daemon:
+            # The daemon holds the process lock and serializes builds
+            _build_via_daemon(params)
+            return
+        _acquire_process_lock()
         app = KB4IT(params)
         app.run()
     except SystemExit as error:
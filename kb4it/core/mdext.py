@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+
+"""
+KB4IT Markdown extension.
+
+# Author: Tomás Vírseda <tomasvirseda@gmail.com>
+# License: GPLv3
+# Description: Emit theme markup from python-markdown's ElementTree
+
+The extension does in the ElementTree, before serialization, what the
+compiler and the theme otherwise do with string passes over the whole
+page:
+
+- insert the TOC block (div#toc, div#toctitle, ul.sectlevelN)
+- wrap h2-h5 headings and their content in sectN/sectionbody divs
+- apply the theme transformations (HTML_TAG_*_MD -> HTML_TAG_*_NEW)
+
+A transformation pair rewrites the start of an opening tag, as the string
+replacement would on the serialized page: the element's start tag is
+serialized, the _MD prefix is replaced with the _NEW one and the result
+is parsed back into attributes. Raw HTML kept aside by python-markdown
+(fenced code, inline HTML) is transformed as a string.
+
+When the document cannot be handled exactly this way (theme patterns
+that are not tags, headings nested in other blocks or inside raw HTML),
+the tree is left untouched and 'themed' stays False, so the caller falls
+back to the string passes.
+"""
+
+import html
+import re
+import xml.etree.ElementTree as etree
+
+from markdown.extensions import Extension
+from markdown.serializers import _escape_attrib_html
+from markdown.treeprocessors import Treeprocessor
+
+# First line of compiled fragments that are already themed
+THEMED_SENTINEL = "<!-- kb4it:themed -->"
+
+SECTION_CLASSES = {"h2": "sect1", "h3": "sect2", "h4": "sect3", "h5": "sect4"}
+RAW_HEADING_RE = re.compile(r"<h[2-5][ >]")
+VOID_TAGS = {"area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta", "source", "track", "wbr"}
+
+_TAG_RE = re.compile(r"<([a-zA-Z][\w-]*)")
+_ATTR_RE = re.compile(r"""\s*([^\s"'>/=]+)(?:\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'>]+)))?""")
+
+
+def parse_start_tag(fragment: str):
+    """Parse an opening tag.
+
+    Return (tag, [(name, value)], rest) where rest is whatever follows the
+    closing '>' (None if the tag is not closed). Boolean attributes get
+    their name as value, as python-markdown expects.
+    """
+    match = _TAG_RE.match(fragment)
+    if match is None:
+        return None, [], None
+    tag = match.group(1).lower()
+    attrs = []
+    pos = match.end()
+    while pos < len(fragment):
+        stripped = fragment[pos:].lstrip()
+        if stripped.startswith(">"):
+            return tag, attrs, stripped[1:]
+        if stripped.startswith("/>"):
+            return tag, attrs, stripped[2:]
+        attr = _ATTR_RE.match(fragment, pos)
+        if attr is None or attr.end() == pos:
+            break
+        name = attr.group(1).lower()
+        value = next((v for v in attr.group(2, 3, 4) if v is not None), None)
+        attrs.append((name, name if value is None else html.unescape(value)))
+        pos = attr.end()
+    return tag, attrs, None
+
+
+def serialize_start_tag(tag: str, items, sort: bool = True) -> str:
+    """Return an opening tag as python-markdown writes it.
+
+    With sort=False, attributes keep their order (used for the blocks
+    KB4IT used to write by hand, like the TOC container).
+    """
+    parts = [f"<{tag}"]
+    for key, value in sorted(items) if sort else items:
+        value = _escape_attrib_html(value)
+        parts.append(f" {value}" if key == value else f' {key}="{value}"')
+    parts.append(">")
+    return "".join(parts)
+
+
+class ThemeRules:
+    """Theme transformation pairs grouped by the tag they apply to.
+
+    The result of applying the pairs only depends on the element's start
+    tag, so it is remembered: most tags (sections, admonitions) repeat
+    across a page and across pages.
+    """
+
+    MEMO_SIZE = 4096
+
+    def __init__(self, rules: dict):
+        self.rules = rules
+        self.prefixes = {tag: tuple(old for old, _ in pairs) for tag, pairs in rules.items()}
+        self._memo = {}
+
+    @classmethod
+    def from_pairs(cls, pairs):
+        """Build rules from (old, new) pairs.
+
+        Return None if a non-empty pattern is not the start of a tag.
+        """
+        rules = {}
+        for old, new in pairs:
+            if not old:
+                continue
+            tag = parse_start_tag(old)[0]
+            if tag is None:
+                return None
+            rules.setdefault(tag, []).append((old, new))
+        return cls(rules)
+
+    def _rewrite(self, tag, start, sort):
+        """Apply the pairs, in order, to a start tag.
+
+        Return (tag, attributes, text prefix, tail prefix), or None if no
+        pair matches.
+        """
+        result = None
+        text = tail = ""
+        for old, new in self.rules[tag]:
+            if not start.startswith(old):
+                continue
+            new_tag, attrs, rest = parse_start_tag(new + start[len(old):])
+            if new_tag is None or rest is None:
+                continue
+            # Duplicated attributes: the first one wins, as in browsers
+            attrib = {}
+            for name, value in attrs:
+                attrib.setdefault(name, value)
+            if new_tag in VOID_TAGS:
+                tail = rest + tail
+            else:
+                text = rest + text
+            tag = new_tag
+            result = (tag, attrib, text, tail)
+            start = serialize_start_tag(tag, attrib.items(), sort)
+        return result
+
+    def apply(self, element, sort: bool = True):
+        """Apply the matching pairs, in order, to an element."""
+        tag = element.tag
+        prefixes = self.prefixes.get(tag)
+        if prefixes is None:
+            return
+        start = serialize_start_tag(tag, element.items(), sort)
+        if not start.startswith(prefixes):
+            return
+        key = (start, sort)
+        try:
+            result = self._memo[key]
+        except KeyError:
+            result = self._rewrite(tag, start, sort)
+            if len(self._memo) >= self.MEMO_SIZE:
+                self._memo.clear()
+            self._memo[key] = result
+        if result is None:
+            return
+        element.tag, attrib, text, tail = result
+        element.attrib.clear()
+        element.attrib.update(attrib)
+        if text:
+            element.text = text + (element.text or "")
+        if tail:
+            element.tail = tail + (element.tail or "")
+
+
+class ThemeTreeprocessor(Treeprocessor):
+    """Build KB4IT page structure and theme markup in the tree."""
+
+    def __init__(self, md, rules, transform):
+        super().__init__(md)
+        self.rules = rules
+        self.transform = transform
+        self.themed = False
+
+    def run(self, root):
+        self.themed = False
+        stash = self.md.htmlStash.rawHtmlBlocks
+        for block in stash:
+            if not isinstance(block, str) or RAW_HEADING_RE.search(block):
+                return None
+        for parent in root.iter():
+            if parent is not root and any(child.tag in SECTION_CLASSES for child in parent):
+                return None
+
+        toc = self.build_toc()
+        self.wrap_sections(root)
+        if self.rules.rules:
+            for element in root.iter():
+                self.rules.apply(element)
+        if toc is not None:
+            # Only the container is themed: extract_toc() parses the rest
+            self.rules.apply(toc, sort=False)
+            root.insert(0, toc)
+        for index, block in enumerate(stash):
+            stash[index] = self.transform(block)
+        self.themed = True
+        return None
+
+    def build_toc(self):
+        """Return the TOC block, or None if the document has no headings."""
+        tokens = getattr(self.md, "toc_tokens", None)
+        if not tokens or "toc" not in self.md.treeprocessors:
+            return None
+        inner = self.md.treeprocessors["toc"].build_toc_div(tokens)
+        toc = etree.Element("div")
+        toc.set("id", "toc")
+        toc.set("class", "toc")
+        toc.text = inner.text
+        title = etree.SubElement(toc, "div")
+        title.set("id", "toctitle")
+        title.text = "Contents"
+        title.tail = "\n"
+        for child in list(inner):
+            if child.tag == "ul":
+                # Nested lists are left as python-markdown writes them
+                child.set("class", "sectlevel1")
+            toc.append(child)
+        toc.tail = (inner.tail or "") + "\n"
+        return toc
+
+    def wrap_sections(self, root):
+        """Nest top-level h2-h5 headings and what follows in sections."""
+        children = list(root)
+        if not any(child.tag in SECTION_CLASSES for child in children):
+            return
+        for child in children:
+            root.remove(child)
+        stack = []  # (heading level, sectionbody)
+        for child in children:
+            if child.tag in SECTION_CLASSES:
+                level = int(child.tag[1])
+                while stack and stack[-1][0] >= level:
+                    stack.pop()
+                parent = stack[-1][1] if stack else root
+                section = etree.SubElement(parent, "div")
+                section.set("class", SECTION_CLASSES[child.tag])
+                section.append(child)
+                body = etree.SubElement(section, "div")
+                body.set("class", "sectionbody")
+                body.text = child.tail
+                child.tail = None
+                stack.append((level, body))
+            elif stack:
+                stack[-1][1].append(child)
+            else:
+                root.append(child)
+        # The last section is closed right after its content
+        last = stack[-1][1] if stack else root
+        if len(last) and last[-1].tail:
+            last[-1].tail = last[-1].tail.rstrip()
+
+
+class ThemeExtension(Extension):
+    """Register ThemeTreeprocessor, after python-markdown's own ones."""
+
+    def __init__(self, rules, transform, **kwargs):
+        self.rules = rules
+        self.transform = transform
+        super().__init__(**kwargs)
+
+    def extendMarkdown(self, md):
+        md.treeprocessors.register(ThemeTreeprocessor(md, self.rules, self.transform), "kb4it_theme", -10)
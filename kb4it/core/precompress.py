@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+
+"""
+Precompressed copies of the website files.
+
+# Author: Tomás Vírseda <tomasvirseda@gmail.com>
+# License: GPLv3
+# Description: Write .gz and .br sidecars for web servers (gzip_static)
+
+Web servers like nginx (gzip_static, brotli_static) serve 'page.html.gz'
+instead of compressing 'page.html' on every request. KB4IT writes those
+sidecars for HTML, CSS, JS and JSON files: .gz always, .br when the
+'brotli' module is installed.
+
+Compression runs on a thread pool (zlib and brotli release the GIL) and
+only for the files a build changed. A stamp file in the target directory
+records the settings the sidecars were made with; when it is missing or
+different, every file is compressed again.
+"""
+
+import gzip
+import os
+import stat
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from kb4it.core.log import get_logger
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_EXTENSIONS = (".html", ".css", ".js", ".json")
+SIDECAR_EXTENSIONS = (".gz", ".br")
+GZIP_LEVEL = 9
+BROTLI_QUALITY = 11
+STAMP_FILE = ".kb4it-precompressed"
+
+
+def is_compressible(relpath: str) -> bool:
+    """Return True if a file of the website gets sidecars."""
+    name = os.path.basename(relpath)
+    return not name.startswith(".") and name.endswith(COMPRESSIBLE_EXTENSIONS)
+
+
+def _write_sidecar(path, data, st):
+    """Replace path with data, with the mode and times of the original."""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    with os.fdopen(fd, "wb") as fh:
+        fh.write(data)
+    os.chmod(tmp_path, stat.S_IMODE(st.st_mode))
+    os.utime(tmp_path, ns=(st.st_atime_ns, st.st_mtime_ns))
+    os.replace(tmp_path, path)
+
+
+class Precompressor:
+    """Sidecars of the files in a target directory."""
+
+    def __init__(self, root, workers: int = 1):
+        self.log = get_logger("Precompress")
+        self.root = str(root)
+        self.workers = max(1, workers)
+        self.suffixes = (".gz", ".br") if brotli is not None else (".gz",)
+        self.settings = f"gzip={GZIP_LEVEL} brotli={BROTLI_QUALITY if brotli is not None else 'no'}"
+        self.stamp_path = os.path.join(self.root, STAMP_FILE)
+
+    def has_stamp(self) -> bool:
+        """Return True if sidecars were written in this directory."""
+        return os.path.exists(self.stamp_path)
+
+    def is_current(self) -> bool:
+        """Return True if the existing sidecars match the settings."""
+        try:
+            with open(self.stamp_path, "r", encoding="utf-8") as fh:
+                return fh.read().strip() == self.settings
+        except OSError:
+            return False
+
+    def save_stamp(self):
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as fh:
+            fh.write(f"{self.settings}\n")
+        # Published with the website
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, self.stamp_path)
+
+    def drop_stamp(self):
+        try:
+            os.unlink(self.stamp_path)
+        except FileNotFoundError:
+            pass
+
+    def scan(self, exclude=()) -> list:
+        """Return every compressible file, relative to the root.
+
+        Top-level entries named in exclude are skipped.
+        """
+        relpaths = []
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            if dirpath == self.root:
+                dirnames[:] = [name for name in dirnames if name not in exclude]
+            reldir = os.path.relpath(dirpath, self.root)
+            for name in filenames:
+                relpath = name if reldir == "." else os.path.join(reldir, name)
+                if is_compressible(relpath):
+                    relpaths.append(relpath)
+        return relpaths
+
+    def _compress(self, relpath) -> list:
+        path = os.path.join(self.root, relpath)
+        with open(path, "rb") as fh:
+            data = fh.read()
+        st = os.stat(path)
+        written = []
+        for suffix in self.suffixes:
+            existed = os.path.exists(path + suffix)
+            if suffix == ".gz":
+                compressed = gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0)
+            else:
+                compressed = brotli.compress(data, quality=BROTLI_QUALITY)
+            _write_sidecar(path + suffix, compressed, st)
+            written.append(("modified" if existed else "added", relpath + suffix))
+        return written
+
+    def compress(self, relpaths) -> list:
+        """Write the sidecars of files; return [(status, sidecar path)]."""
+        relpaths = sorted(relpaths)
+        if not relpaths:
+            return []
+        if self.workers == 1 or len(relpaths) == 1:
+            results = map(self._compress, relpaths)
+        else:
+            with ThreadPoolExecutor(max_workers=self.workers) as exe:
+                results = list(exe.map(self._compress, relpaths))
+        return [item for written in results for item in written]
+
+    def remove(self, relpaths, suffixes=SIDECAR_EXTENSIONS) -> list:
+        """Delete the sidecars of files; return the sidecar paths deleted."""
+        removed = []
+        for relpath in relpaths:
+            for suffix in suffixes:
+                try:
+                    os.unlink(os.path.join(self.root, relpath + suffix))
+                    removed.append(relpath + suffix)
+                except FileNotFoundError:
+                    pass
+        return removed
+
+    def compress_all(self, exclude=()):
+        """Write the sidecars of every file, as after a settings change.
+
+        Sidecars of a kind no longer written (.br without the brotli
+        module) are deleted, so they are not served out of date.
+        Return ([(status, sidecar path)], [sidecar paths deleted]).
+        """
+        relpaths = self.scan(exclude)
+        unused = [suffix for suffix in SIDECAR_EXTENSIONS if suffix not in self.suffixes]
+        removed = self.remove(relpaths, unused)
+        return self.compress(relpaths), removed
@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+
+"""
+SQLite storage for the KB4IT build database.
+
+# Author: Tomás Vírseda <tomasvirseda@gmail.com>
+# License: GPLv3
+# Description: Optional replacement for kbdict.json (repo.json "database": "sqlite")
+
+The store keeps the same data as kbdict.json split in tables, so a
+build only writes the rows that changed since the previous one:
+
+- documents: one row per document (kbdict["document"] entry as JSON)
+- hashes:    change detection data per document: body and metadata
+             hashes and the source stat (mtime_ns, size, inode)
+- keyvalues: (document, key, value) triples, indexed by (key, value)
+             (n counts how many times the document is listed for it)
+- dates:     raw Date strings and their parsed value
+- meta:      schema version, KB4IT version and other top-level entries
+"""
+
+import json
+import sqlite3
+
+from kb4it.core.log import get_logger
+
+SCHEMA_VERSION = 2
+
+# Top-level kbdict entries with a table of their own
+_TABLE_ENTRIES = ("document", "metadata", "dates", "kb4it_version")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    name  TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS documents (
+    doc_id TEXT PRIMARY KEY,
+    record TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS hashes (
+    doc_id        TEXT PRIMARY KEY,
+    body_hash     TEXT,
+    metadata_hash TEXT,
+    mtime_ns      INTEGER,
+    size          INTEGER,
+    ino           INTEGER
+);
+CREATE TABLE IF NOT EXISTS keyvalues (
+    doc_id TEXT NOT NULL,
+    key    TEXT NOT NULL,
+    value  TEXT NOT NULL,
+    n      INTEGER NOT NULL DEFAULT 1,
+    PRIMARY KEY (doc_id, key, value)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS keyvalues_lookup ON keyvalues (key, value);
+CREATE TABLE IF NOT EXISTS dates (
+    raw    TEXT PRIMARY KEY,
+    parsed TEXT
+);
+"""
+
+
+def _invert_metadata(metadata: dict) -> dict:
+    """Return docId -> {(key, value): n} from kbdict["metadata"]."""
+    pairs = {}
+    for key, values in metadata.items():
+        for value, docs in values.items():
+            for docId in docs:
+                doc_pairs = pairs.setdefault(docId, {})
+                doc_pairs[(key, value)] = doc_pairs.get((key, value), 0) + 1
+    return pairs
+
+
+class KBStore:
+    """Build database stored in SQLite.
+
+    load() returns a kbdict with the same structure as kbdict.json and
+    remembers what is stored. save() compares the new kbdict with it and
+    only upserts or deletes the rows that differ.
+    """
+
+    def __init__(self, path):
+        """Open (or create) the database at path."""
+        self.log = get_logger("Store")
+        self.path = str(path)
+        self.conn = sqlite3.connect(self.path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self._setup_schema()
+        self._docs = {}
+        self._hashes = {}
+        self._pairs = {}
+        self._dates = {}
+        self._meta = {}
+
+    def _setup_schema(self):
+        """Create tables, dropping them first if the schema is outdated."""
+        version = None
+        try:
+            row = self.conn.execute("SELECT value FROM meta WHERE name = 'schema_version'").fetchone()
+            version = int(row[0]) if row else None
+        except sqlite3.OperationalError:
+            pass
+        if version is not None and version != SCHEMA_VERSION:
+            self.log.warning(f"[STORE] SCHEMA_MISMATCH stored={version} current={SCHEMA_VERSION}")
+            with self.conn:
+                for table in ("meta", "documents", "hashes", "keyvalues", "dates"):
+                    self.conn.execute(f"DROP TABLE IF EXISTS {table}")
+        with self.conn:
+            self.conn.executescript(_SCHEMA)
+            self.conn.execute(
+                "INSERT OR REPLACE INTO meta (name, value) VALUES ('schema_version', ?)",
+                (str(SCHEMA_VERSION),),
+            )
+
+    def is_empty(self) -> bool:
+        """Return True if no build has been stored yet."""
+        row = self.conn.execute("SELECT 1 FROM meta WHERE name = 'kb4it_version'").fetchone()
+        return row is None
+
+    def load(self) -> dict:
+        """Return the stored build database as a kbdict."""
+        kbdict = {"document": {}, "metadata": {}, "dates": {}}
+        documents = kbdict["document"]
+        cursor = self.conn.execute("SELECT doc_id, record FROM documents ORDER BY doc_id")
+        for docId, record in cursor:
+            documents[docId] = json.loads(record)
+            self._docs[docId] = record
+
+        cursor = self.conn.execute("SELECT doc_id, body_hash, metadata_hash, mtime_ns, size, ino FROM hashes")
+        for docId, body_hash, metadata_hash, *stat in cursor:
+            stat = None if stat[0] is None else stat
+            self._hashes[docId] = (body_hash, metadata_hash, stat)
+            if docId in documents:
+                documents[docId]["body_hash"] = body_hash
+                documents[docId]["metadata_hash"] = metadata_hash
+                if stat is not None:
+                    documents[docId]["stat"] = stat
+
+        # Documents are listed per value sorted case-insensitively, as
+        # the Processor does
+        metadata = kbdict["metadata"]
+        cursor = self.conn.execute("SELECT doc_id, key, value, n FROM keyvalues ORDER BY doc_id")
+        for docId, key, value, n in cursor:
+            metadata.setdefault(key, {}).setdefault(value, []).extend([docId] * n)
+            self._pairs.setdefault(docId, {})[(key, value)] = n
+        for values in metadata.values():
+            for docs in values.values():
+                docs.sort(key=lambda y: y.lower())
+
+        for raw, parsed in self.conn.execute("SELECT raw, parsed FROM dates"):
+            kbdict["dates"][raw] = parsed
+            self._dates[raw] = parsed
+
+        for name, value in self.conn.execute("SELECT name, value FROM meta"):
+            self._meta[name] = value
+            if name == "kb4it_version":
+                kbdict["kb4it_version"] = value
+            elif name.startswith("kbdict."):
+                kbdict[name[len("kbdict."):]] = json.loads(value)
+
+        self.log.debug(f"[STORE] LOADED path={self.path} docs={len(documents)}")
+        return kbdict
+
+    def save(self, kbdict: dict) -> bool:
+        """Store kbdict, writing only what changed since load().
+
+        Return True if anything was written.
+        """
+        documents = kbdict.get("document", {})
+        pairs = _invert_metadata(kbdict.get("metadata", {}))
+        n_docs = n_hashes = n_pairs = n_dates = n_meta = 0
+
+        with self.conn:
+            for docId, entry in documents.items():
+                entry = dict(entry)
+                hashes = (entry.pop("body_hash", None), entry.pop("metadata_hash", None), entry.pop("stat", None))
+                record = json.dumps(entry, sort_keys=True, ensure_ascii=False)
+                if self._docs.get(docId) != record:
+                    self.conn.execute(
+                        "INSERT OR REPLACE INTO documents (doc_id, record) VALUES (?, ?)",
+                        (docId, record),
+                    )
+                    self._docs[docId] = record
+                    n_docs += 1
+                if self._hashes.get(docId) != hashes:
+                    body_hash, metadata_hash, stat = hashes
+                    self.conn.execute(
+                        "INSERT OR REPLACE INTO hashes (doc_id, body_hash, metadata_hash, mtime_ns, size, ino)"
+                        " VALUES (?, ?, ?, ?, ?, ?)",
+                        (docId, body_hash, metadata_hash, *(stat or (None, None, None))),
+                    )
+                    self._hashes[docId] = hashes
+                    n_hashes += 1
+                doc_pairs = pairs.get(docId, {})
+                if self._pairs.get(docId, {}) != doc_pairs:
+                    self.conn.execute("DELETE FROM keyvalues WHERE doc_id = ?", (docId,))
+                    self.conn.executemany(
+                        "INSERT INTO keyvalues (doc_id, key, value, n) VALUES (?, ?, ?, ?)",
+                        [(docId, key, value, n) for (key, value), n in doc_pairs.items()],
+                    )
+                    self._pairs[docId] = doc_pairs
+                    n_pairs += 1
+
+            deleted = [docId for docId in self._docs if docId not in documents]
+            for docId in deleted:
+                for table in ("documents", "hashes", "keyvalues"):
+                    self.conn.execute(f"DELETE FROM {table} WHERE doc_id = ?", (docId,))
+                self._docs.pop(docId, None)
+                self._hashes.pop(docId, None)
+                self._pairs.pop(docId, None)
+
+            dates = kbdict.get("dates", {})
+            for raw, parsed in dates.items():
+                if raw not in self._dates or self._dates[raw] != parsed:
+                    self.conn.execute("INSERT OR REPLACE INTO dates (raw, parsed) VALUES (?, ?)", (raw, parsed))
+                    self._dates[raw] = parsed
+                    n_dates += 1
+            for raw in [raw for raw in self._dates if raw not in dates]:
+                self.conn.execute("DELETE FROM dates WHERE raw = ?", (raw,))
+                del self._dates[raw]
+                n_dates += 1
+
+            meta = {f"kbdict.{name}": json.dumps(value, sort_keys=True, ensure_ascii=False)
+                    for name, value in kbdict.items() if name not in _TABLE_ENTRIES}
+            meta["kb4it_version"] = kbdict.get("kb4it_version")
+            for name, value in meta.items():
+                if self._meta.get(name) != value:
+                    self.conn.execute("INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)", (name, value))
+                    self._meta[name] = value
+                    n_meta += 1
+            for name in [name for name in self._meta if name.startswith("kbdict.") and name not in meta]:
+                self.conn.execute("DELETE FROM meta WHERE name = ?", (name,))
+                del self._meta[name]
+                n_meta += 1
+
+        changed = n_docs + n_hashes + n_pairs + len(deleted) + n_dates + n_meta
+        self.log.debug(
+            f"[STORE] SAVED path={self.path} docs={n_docs} hashes={n_hashes} "
+            f"keyvalues={n_pairs} deleted={len(deleted)} dates={n_dates} meta={n_meta}"
+        )
+        return changed > 0
+
+    def get_docs_by_key_value(self, key: str, value: str) -> list:
+        """Return the documents stored for a key/value pair."""
+        cursor = self.conn.execute(
+            "SELECT doc_id FROM keyvalues WHERE key = ? AND value = ? ORDER BY doc_id",
+            (key, value),
+        )
+        return [row[0] for row in cursor]
+
+    def close(self):
+        """Close the connection."""
+        self.conn.close()
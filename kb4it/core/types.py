@@ -47,6 +47,8 @@ class DocumentMeta(TypedDict, total=False):
     """Per-document entry inside kbdict["document"]."""
     content:       str
     keys:          dict
+    key_order:     list   # frontmatter key order (keys is saved sorted)
+    stat:          list   # [mtime_ns, size, inode] of the source
     body_hash:     str
     metadata_hash: str
     compile:       bool
@@ -56,6 +58,7 @@ class KBDict(TypedDict, total=False):
     """Top-level structure of the kbdict JSON cache."""
     document:      dict   # dict[str, DocumentMeta]
     metadata:      dict   # dict[str, dict[str, list[str]]]
+    dates:         dict   # dict[str, str | None], raw Date -> parsed
     kb4it_version: str
 
 
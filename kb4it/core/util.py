@@ -9,6 +9,9 @@ Utils functions used along the project.
 # Description: Generic functions module
 """
 
+import errno
+import fcntl
+import filecmp
 import glob
 import hashlib
 import json
@@ -20,6 +23,7 @@ import re
 import shutil
 import subprocess
 import time
+from dataclasses import dataclass, field
 from datetime import datetime
 from functools import wraps
 
@@ -150,6 +154,9 @@ def get_default_workers():
 def copydir(source, dest):
     """Copy a directory structure overwriting existing files.
 
+    Files already in dest with the same content are left alone; the
+    others are replaced, never written in place (see sync_file).
+
     https://gist.github.com/dreikanter/5650973#gistcomment-835606
     """
     for root, dirs, files in os.walk(source):
@@ -164,12 +171,125 @@ def copydir(source, dest):
                 os.makedirs(dest_path, exist_ok=True)
 
             try:
-                shutil.copyfile(os.path.join(root, file),
-                                os.path.join(dest_path, file))
+                sync_file(os.path.join(root, file),
+                          os.path.join(dest_path, file))
             except PermissionError:
                 log.warning(f"Check permissions for file {file}")
 
 
+# How files are deployed from the cache to the target directory
+DEPLOY_MODES = ("copy", "link", "reflink", "auto")
+
+# ioctl(2) request to share the extents of a file (Linux, btrfs/xfs)
+FICLONE = 0x40049409
+
+# Errors meaning a link or a reflink is not possible between two paths
+_NO_LINK_ERRNOS = {errno.EXDEV, errno.EPERM, errno.EMLINK, errno.EOPNOTSUPP, errno.EINVAL, errno.ENOTTY}
+
+
+def _reflink(source, dest):
+    """Create dest sharing the data blocks of source."""
+    with open(source, "rb") as fsrc, open(dest, "wb") as fdst:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    shutil.copystat(source, dest)
+
+
+def same_file_content(source, dest) -> bool:
+    """Return True if dest exists with the content of source.
+
+    Hard links to the same file and files with the same size and
+    modification time are not read.
+    """
+    try:
+        st_dest = os.stat(dest)
+    except FileNotFoundError:
+        return False
+    st_source = os.stat(source)
+    if os.path.samestat(st_source, st_dest):
+        return True
+    if st_source.st_size != st_dest.st_size:
+        return False
+    if st_source.st_mtime_ns == st_dest.st_mtime_ns:
+        return True
+    return filecmp.cmp(source, dest, shallow=False)
+
+
+def sync_file(source, dest, mode: str = "copy") -> str:
+    """Make dest a copy of source, unless it has its content already.
+
+    Modes (see DEPLOY_MODES):
+    - copy: copy data and timestamps
+    - link: hard link dest to source
+    - reflink: share the data blocks (copy-on-write filesystems)
+    - auto: reflink, then link, then copy
+
+    A link or reflink that is not possible (different filesystems, no
+    filesystem support) falls back to the next method. dest is replaced
+    atomically, so a file linked to it is never modified in place.
+
+    Return what was done: 'skipped', 'reflinked', 'linked' or 'copied'.
+    """
+    if same_file_content(source, dest):
+        return "skipped"
+    methods = {
+        "copy": ("copied",),
+        "link": ("linked", "copied"),
+        "reflink": ("reflinked", "copied"),
+        "auto": ("reflinked", "linked", "copied"),
+    }.get(mode, ("copied",))
+    tmp_path = f"{dest}.{os.getpid()}.tmp"
+    for action in methods:
+        try:
+            if action == "reflinked":
+                _reflink(source, tmp_path)
+            elif action == "linked":
+                os.link(source, tmp_path)
+            else:
+                shutil.copy2(source, tmp_path)
+            os.replace(tmp_path, dest)
+            return action
+        except OSError as error:
+            try:
+                os.unlink(tmp_path)
+            except FileNotFoundError:
+                pass
+            if action == "copied" or error.errno not in _NO_LINK_ERRNOS:
+                raise
+
+
+def replace_with_link(source, dest) -> bool:
+    """Atomically replace dest with a hard link to source.
+
+    Return False if source cannot be linked there (other filesystem, no
+    filesystem support).
+    """
+    tmp_path = f"{dest}.{os.getpid()}.tmp"
+    try:
+        os.link(source, tmp_path)
+    except OSError as error:
+        if error.errno not in _NO_LINK_ERRNOS:
+            raise
+        return False
+    os.replace(tmp_path, dest)
+    return True
+
+
+def link_tree(source, dest):
+    """Create dest as a copy of the source tree made of hard links.
+
+    Files are copied when they cannot be linked. Symbolic links are
+    kept as they are.
+    """
+    def link_or_copy(src, dst):
+        try:
+            os.link(src, dst)
+        except OSError as error:
+            if error.errno not in _NO_LINK_ERRNOS:
+                raise
+            shutil.copy2(src, dst)
+    shutil.copytree(source, dest, symlinks=True, copy_function=link_or_copy)
+
+
 def get_source_docs(path: str):
     """Get source documents (.md, .markdown) from a given path."""
     docs = []
@@ -290,6 +410,11 @@ def get_hash_from_file(path):
     return fhash
 
 
+def _strip_title(body: str) -> str:
+    """Remove the leading H1 heading from a document body."""
+    return re.sub(r"^#[^\n]*\n?", "", body, count=1)
+
+
 def get_hash_from_body(path):
     """Get blake2b hash for the document body.
 
@@ -302,30 +427,63 @@ def get_hash_from_body(path):
         content = fin.read()
     end = content.find("\n---", 3)
     if end >= 0:
-        body = content[end + 4:].lstrip("\n")
-        body = re.sub(r"^#[^\n]*\n?", "", body, count=1)
+        body = _strip_title(content[end + 4:].lstrip("\n"))
     else:
         body = content
     return hashlib.blake2b(body.encode("utf-8")).hexdigest()
 
 
-def get_markdown_attributes(docpath: str):
-    """Get metadata from a Markdown document's YAML frontmatter."""
+@dataclass
+class ParsedDocument:
+    """Ingestion record for a source document.
+
+    Built once per file during extraction and passed along to analysis
+    and compilation, so a source is read, split and parsed only once.
+    content and body are None when the record was restored from the
+    previous build without reading the file.
+    """
+    path: str
+    content: str | None = ""
+    keys: dict = field(default_factory=dict)
+    body: str | None = ""
+    title: str = ""
+    body_hash: str | None = None
+    metadata_hash: str | None = None
+    valid: bool = False
+    reason: str = ""
+
+    @property
+    def docId(self) -> str:
+        return os.path.basename(self.path)
+
+
+def parse_markdown_document(docpath: str) -> ParsedDocument:
+    """Read a Markdown document once and extract everything KB4IT needs.
+
+    Returns a ParsedDocument with the full source, the frontmatter keys,
+    the body, the title and the body/metadata hashes used for change
+    detection. When the document is invalid, 'valid' is False and
+    'reason' explains why.
+    """
     basename = os.path.basename(docpath)
+    doc = ParsedDocument(path=docpath)
     keys = {}
 
     try:
         with open(docpath, "r", encoding="utf-8") as fh:
             content = fh.read()
+        doc.content = content
 
         if not content.startswith("---"):
             log.error(f"[UTIL] DOC_INVALID doc={basename} reason=missing_frontmatter")
-            return {}, False, "missing_frontmatter"
+            doc.reason = "missing_frontmatter"
+            return doc
 
         end = content.find("\n---", 3)
         if end < 0:
             log.error(f"[UTIL] DOC_INVALID doc={basename} reason=missing_frontmatter_close")
-            return {}, False, "missing_frontmatter_close"
+            doc.reason = "missing_frontmatter_close"
+            return doc
 
         fm_text = content[3:end].strip()
         body = content[end + 4:].lstrip("\n")
@@ -333,13 +491,15 @@ def get_markdown_attributes(docpath: str):
         fm = yaml.safe_load(fm_text) if fm_text else {}
         if not isinstance(fm, dict):
             log.error(f"[UTIL] DOC_INVALID doc={basename} reason=invalid_frontmatter")
-            return {}, False, "invalid_frontmatter"
+            doc.reason = "invalid_frontmatter"
+            return doc
 
         # Title comes from the first # heading in the body
         title_match = re.search(r"^#\s+(.+)$", body, re.MULTILINE)
         if not title_match:
             log.error(f"[UTIL] DOC_INVALID doc={basename} reason=missing_h1_title")
-            return {}, False, "missing_h1_title"
+            doc.reason = "missing_h1_title"
+            return doc
 
         keys["Title"] = [title_match.group(1).strip()]
 
@@ -358,19 +518,40 @@ def get_markdown_attributes(docpath: str):
 
     except yaml.YAMLError as err:
         log.error(f"[UTIL] DOC_INVALID doc={basename} reason=yaml_error")
-        return {}, False, f"yaml_error: {err}"
+        doc.reason = f"yaml_error: {err}"
+        return doc
     except Exception as err:
         log.error(f"[UTIL] DOC_INVALID doc={basename} reason=error error={err}")
-        return {}, False, str(err)
+        doc.reason = str(err)
+        return doc
 
-    return keys, True, "Success"
+    doc.keys = keys
+    doc.body = body
+    doc.title = keys["Title"][0]
+    doc.body_hash = hashlib.blake2b(_strip_title(body).encode("utf-8")).hexdigest()
+    doc.metadata_hash = get_hash_from_dict(keys)
+    doc.valid = True
+    doc.reason = "Success"
+    return doc
+
+
+def parse_document(docpath: str) -> ParsedDocument:
+    """Parse a source document according to its format."""
+    if docpath.endswith((".md", ".markdown")):
+        return parse_markdown_document(docpath)
+    return ParsedDocument(path=docpath, reason="unsupported_format")
+
+
+def get_markdown_attributes(docpath: str):
+    """Get metadata from a Markdown document's YAML frontmatter."""
+    doc = parse_markdown_document(docpath)
+    return doc.keys, doc.valid, doc.reason
 
 
 def get_document_attributes(docpath: str):
     """Extract metadata from a Markdown document."""
-    if docpath.endswith((".md", ".markdown")):
-        return get_markdown_attributes(docpath)
-    return {}, False, "unsupported_format"
+    doc = parse_document(docpath)
+    return doc.keys, doc.valid, doc.reason
 
 
 def get_hash_from_dict(adict: dict) -> str:
@@ -385,6 +566,114 @@ def get_hash_from_list(alist: list) -> str:
     return hashlib.blake2b(serialized.encode("utf-8")).hexdigest()
 
 
+def _strings_interact(a: str, b: str) -> bool:
+    """Return True if b can overlap a, or be built next to or around it.
+
+    That is: one contains the other, or a suffix of one is a prefix of
+    the other.
+    """
+    if a in b or b in a:
+        return True
+    for n in range(1, min(len(a), len(b))):
+        if a.endswith(b[:n]) or b.endswith(a[:n]):
+            return True
+    return False
+
+
+def compile_replacements(pairs):
+    """Return a function applying (old, new) replacements to a string.
+
+    The result is always the same as calling str.replace for each pair in
+    order. When that order cannot matter (no two patterns can overlap and
+    no replacement can create or be part of another pair's pattern), all
+    pairs are applied in one pass with an alternation regex, instead of
+    copying the whole string once per pair. Otherwise the replacements are
+    applied one after another.
+    """
+    pairs = [(old, new) for old, new in pairs if old]
+    if not pairs:
+        return lambda content: content
+
+    single_pass = len({old for old, _ in pairs}) == len(pairs)
+    for i, (old_i, new_i) in enumerate(pairs):
+        if not single_pass:
+            break
+        for j, (old_j, _) in enumerate(pairs):
+            if i == j:
+                continue
+            if _strings_interact(old_i, old_j) or _strings_interact(new_i, old_j):
+                single_pass = False
+                break
+
+    if not single_pass:
+        def replace_all(content):
+            for old, new in pairs:
+                content = content.replace(old, new)
+            return content
+        return replace_all
+
+    table = dict(pairs)
+    regex = re.compile("|".join(re.escape(old) for old in table))
+    lookup = table.__getitem__
+    return lambda content: regex.sub(lambda match: lookup(match.group()), content)
+
+
+# Tags whose surrounding whitespace is not rendered
+_BLOCK_TAGS = (
+    "html head body title meta link base script style noscript div p ul ol li dl dt dd "
+    "table thead tbody tfoot tr td th caption colgroup col section article aside header "
+    "footer nav main h1 h2 h3 h4 h5 h6 hr br form fieldset legend figure figcaption "
+    "blockquote pre details summary option"
+).split()
+_SPACE = " \t\n\r\f"
+_ATTRS = r"""(?:[^>"']|"[^"]*"|'[^']*')*+"""
+_RAW_ELEMENT_RE = re.compile(rf"(<(pre|textarea|script|style)\b{_ATTRS}>.*?</\2\s*>)", re.DOTALL)
+_COMMENT_RE = re.compile(r"<!--(?!\[if).*?-->", re.DOTALL)
+# Whitespace around a block-level tag or a declaration (a whitespace run is
+# only tried from its start)
+_BLOCK_SPACE_RE = re.compile(
+    rf"(?=[<{_SPACE}])(?:(?<![{_SPACE}])[{_SPACE}]++)?+"
+    rf"(</?(?:{'|'.join(sorted(_BLOCK_TAGS, key=len, reverse=True))})\b{_ATTRS}>|<![^>]*>)"
+    rf"[{_SPACE}]*+"
+)
+# Whitespace runs in text (not in attribute values) that are not a single space
+_TEXT_SPACE_RE = re.compile(rf"(?: [{_SPACE}]|[\t\n\r\f])[{_SPACE}]*+(?=[^<>]*+(?:<|$))")
+# End tags that may be omitted before the next sibling or the parent end tag
+_OPTIONAL_END_RE = re.compile(
+    r"</li>(?=<li[\s>]|</(?:ul|ol|menu)>)"
+    r"|</dt>(?=<d[td][\s>])"
+    r"|</dd>(?=<d[td][\s>]|</dl>)"
+    r"|</t[dh]>(?=<t[dh][\s>]|</tr>)"
+    r"|</tr>(?=<tr[\s>]|</(?:tbody|thead|tfoot|table)>)"
+    r"|</option>(?=<(?:option|optgroup)[\s>]|</(?:select|datalist|optgroup)>)"
+    r"|</body>(?=</html>|$)|</html>$"
+)
+
+
+def minify_html(html: str) -> str:
+    """Return a page without insignificant whitespace, comments and end tags.
+
+    The page is processed with a few regular expression passes, no tree
+    is built. Contents of pre, textarea, script and style are kept as
+    they are; whitespace next to block-level tags is removed and other
+    whitespace runs become a single space. Conditional comments are kept.
+    Tags are expected in lowercase, as KB4IT writes them; uppercase tags
+    simply keep their whitespace.
+    """
+    # Text, raw element, raw element tag name, text, ...
+    parts = _RAW_ELEMENT_RE.split(html)
+    for index in range(0, len(parts), 3):
+        text = _COMMENT_RE.sub("", parts[index])
+        text = _BLOCK_SPACE_RE.sub(r"\1", text)
+        if index == 0 or parts[index - 1] != "textarea":
+            text = text.lstrip(_SPACE)
+        if index + 1 == len(parts) or parts[index + 2] != "textarea":
+            text = text.rstrip(_SPACE)
+        parts[index] = _TEXT_SPACE_RE.sub(" ", text)
+    del parts[2::3]
+    return _OPTIONAL_END_RE.sub("", "".join(parts))
+
+
 def valid_filename(s):
     """Return a clean filename.
 
@@ -430,56 +719,134 @@ def kb4it_timestamp():
     return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
 
+# Date formats accepted by guess_datetime, tried in order by the slow
+# path. The regular expressions below dispatch the common shapes of
+# these same formats directly, without trying every pattern.
+DATE_PATTERNS = [
+    "%d/%m/%Y",
+    "%d/%m/%Y %H:%M",
+    "%d/%m/%Y %H:%M:%S",
+    "%d.%m.%Y",
+    "%d.%m.%Y %H:%M",
+    "%d.%m.%Y %H:%M:%S",
+    "%d-%m-%Y",
+    "%d-%m-%Y %H:%M",
+    "%d-%m-%Y %H:%M:%S",
+    "%Y/%m/%d",
+    "%Y/%m/%d %H:%M",
+    "%Y/%m/%d %H:%M:%S",
+    "%Y.%m.%d",
+    "%Y.%m.%d %H:%M",
+    "%Y.%m.%d %H:%M:%S",
+    "%Y-%m-%d",
+    "%Y-%m-%d %H:%M",
+    "%Y-%m-%d %H:%M:%S",
+    "%Y/%m/%d %H:%M:%S.%f",
+    "%Y.%m.%d %H:%M:%S.%f",
+    "%Y-%m-%d %H:%M:%S.%f",
+    "%Y-%m-%dT%H:%M:%S",
+    "%Y-%m-%dT%H:%M:%SZ",
+]
+
+# Canonical ISO 8601 shapes, handled by datetime.fromisoformat
+DATE_ISO_RE = re.compile(r"\d{4}-\d{2}-\d{2}(?: \d{2}:\d{2}(?::\d{2})?|T\d{2}:\d{2}:\d{2})?")
+
+# Year first: 2024/1/2, 2024.01.02 10:00, 2024-01-02T10:00:00Z, ...
+DATE_YMD_RE = re.compile(
+    r"(?P<Y>\d{4})(?P<sep>[/.-])(?P<m>\d{1,2})(?P=sep)(?P<d>\d{1,2})"
+    r"(?:(?P<T>[ T])(?P<H>\d{1,2}):(?P<M>\d{1,2})"
+    r"(?::(?P<S>\d{1,2})(?P<f>\.\d{1,6})?)?(?P<Z>Z)?)?"
+)
+
+# Day first: 2/1/2024, 02.01.2024 10:00, 02-01-2024 10:00:00, ...
+DATE_DMY_RE = re.compile(
+    r"(?P<d>\d{1,2})(?P<sep>[/.-])(?P<m>\d{1,2})(?P=sep)(?P<Y>\d{4})"
+    r"(?: (?P<H>\d{1,2}):(?P<M>\d{1,2})(?::(?P<S>\d{1,2}))?)?"
+)
+
+
+def _parse_datetime_fast(sdate):
+    """Parse the common date shapes in one step.
+
+    Return None when the string is not one of them (or it does not
+    represent a valid date), so the caller falls back to trying every
+    pattern in DATE_PATTERNS.
+    """
+    if DATE_ISO_RE.fullmatch(sdate):
+        try:
+            dt = datetime.fromisoformat(sdate)
+        except ValueError:
+            return None
+        return dt if dt.year >= 1000 else None
+
+    match = DATE_YMD_RE.fullmatch(sdate) or DATE_DMY_RE.fullmatch(sdate)
+    if match is None:
+        return None
+    parts = match.groupdict()
+    if parts.get("T") == "T":
+        # Only '%Y-%m-%dT%H:%M:%S' and the same with 'Z'
+        if parts["sep"] != "-" or parts["S"] is None or parts["f"] is not None:
+            return None
+    elif parts.get("Z") is not None:
+        return None
+    if int(parts["Y"]) < 1000 or int(parts["H"] or 0) > 23:
+        return None
+    try:
+        # Microseconds are dropped, as KB4IT works with seconds
+        return datetime(
+            int(parts["Y"]), int(parts["m"]), int(parts["d"]),
+            int(parts["H"] or 0), int(parts["M"] or 0), int(parts["S"] or 0),
+        )
+    except ValueError:
+        return None
+
+
 def guess_datetime(sdate, _cache=None):
     """Guess a datetime object for a given string."""
     cache = _cache if _cache is not None else _default_date_cache
     if cache.has_dt(sdate):
         return cache.get_dt(sdate)
 
-    patterns = [
-        "%d/%m/%Y",
-        "%d/%m/%Y %H:%M",
-        "%d/%m/%Y %H:%M:%S",
-        "%d.%m.%Y",
-        "%d.%m.%Y %H:%M",
-        "%d.%m.%Y %H:%M:%S",
-        "%d-%m-%Y",
-        "%d-%m-%Y %H:%M",
-        "%d-%m-%Y %H:%M:%S",
-        "%Y/%m/%d",
-        "%Y/%m/%d %H:%M",
-        "%Y/%m/%d %H:%M:%S",
-        "%Y.%m.%d",
-        "%Y.%m.%d %H:%M",
-        "%Y.%m.%d %H:%M:%S",
-        "%Y-%m-%d",
-        "%Y-%m-%d %H:%M",
-        "%Y-%m-%d %H:%M:%S",
-        "%Y/%m/%d",
-        "%Y/%m/%d %H:%M",
-        "%Y/%m/%d %H:%M:%S.%f",
-        "%Y.%m.%d",
-        "%Y.%m.%d %H:%M",
-        "%Y.%m.%d %H:%M:%S.%f",
-        "%Y-%m-%d",
-        "%Y-%m-%d %H:%M",
-        "%Y-%m-%d %H:%M:%S.%f",
-        "%Y-%m-%dT%H:%M:%S",
-        "%Y-%m-%dT%H:%M:%SZ",
-    ]
-    timestamp = None
-    for pattern in patterns:
-        try:
-            td = datetime.strptime(sdate, pattern)
-            ts = td.strftime("%Y-%m-%d %H:%M:%S")
-            timestamp = datetime.strptime(ts, "%Y-%m-%d %H:%M:%S")
-            break
-        except ValueError:
-            continue
+    timestamp = _parse_datetime_fast(sdate) if isinstance(sdate, str) else None
+    if timestamp is None:
+        for pattern in DATE_PATTERNS:
+            try:
+                td = datetime.strptime(sdate, pattern)
+                ts = td.strftime("%Y-%m-%d %H:%M:%S")
+                timestamp = datetime.strptime(ts, "%Y-%m-%d %H:%M:%S")
+                break
+            except ValueError:
+                continue
     cache.set_dt(sdate, timestamp)
     return timestamp
 
 
+def load_date_cache(dates: dict, _cache=None):
+    """Preload the date cache with {string: 'YYYY-mm-dd HH:MM:SS'} pairs.
+
+    Used to restore the dates parsed in a previous build. Entries that
+    cannot be read back are ignored.
+    """
+    cache = _cache if _cache is not None else _default_date_cache
+    for sdate, value in dates.items():
+        if cache.has_dt(sdate):
+            continue
+        try:
+            cache.set_dt(sdate, datetime.fromisoformat(value) if value else None)
+        except (TypeError, ValueError):
+            continue
+
+
+def dump_date_cache(sdates, _cache=None) -> dict:
+    """Return {string: 'YYYY-mm-dd HH:MM:SS'} for the given date strings."""
+    cache = _cache if _cache is not None else _default_date_cache
+    dates = {}
+    for sdate in sdates:
+        dt = cache.get_dt(sdate) if cache.has_dt(sdate) else guess_datetime(sdate, cache)
+        dates[sdate] = dt.strftime("%Y-%m-%d %H:%M:%S") if dt else None
+    return dates
+
+
 def string_timestamp(string):
     """Return datetime object from a given timestamp."""
     dt = guess_datetime(string)
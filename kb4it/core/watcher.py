@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+
+"""
+Source directory watcher used by 'kb4it watch'.
+
+# Author: Tomás Vírseda <tomasvirseda@gmail.com>
+# License: GPLv3
+# Description: Wait for changes in the source directory (inotify or polling)
+
+Changes are detected by comparing snapshots of the source tree (path ->
+mtime_ns, size, inode). On Linux, inotify is used only to wake up when
+something happens; elsewhere, or if inotify is not available, the tree
+is polled. Either way, a change is reported once the tree has been
+quiet for the debounce delay, so editors saving several files (or
+writing a temporary file and renaming it) trigger a single rebuild.
+"""
+
+import ctypes
+import ctypes.util
+import os
+import select
+import time
+
+from kb4it.core.log import get_logger
+
+POLL_INTERVAL = 1.0
+
+# inotify(7) constants
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+
+def take_snapshot(path: str) -> dict:
+    """Return {relative path: (mtime_ns, size, inode)} for a directory tree.
+
+    Hidden files and editor backups ('~' suffix) are left out.
+    """
+    snapshot = {}
+    for root, dirs, files in os.walk(path):
+        dirs[:] = [d for d in dirs if not d.startswith(".")]
+        for name in files:
+            if name.startswith(".") or name.endswith("~"):
+                continue
+            filepath = os.path.join(root, name)
+            try:
+                st = os.stat(filepath)
+            except FileNotFoundError:
+                continue
+            snapshot[os.path.relpath(filepath, path)] = (st.st_mtime_ns, st.st_size, st.st_ino)
+    return snapshot
+
+
+class _Inotify:
+    """Minimal inotify binding (ctypes) used to block until an event."""
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.libc = libc
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+
+    def add_tree(self, path: str):
+        """Watch a directory and all its subdirectories."""
+        for root, dirs, _ in os.walk(path):
+            dirs[:] = [d for d in dirs if not d.startswith(".")]
+            if self.libc.inotify_add_watch(self.fd, os.fsencode(root), WATCH_MASK) < 0:
+                errno = ctypes.get_errno()
+                raise OSError(errno, os.strerror(errno))
+
+    def wait(self, timeout: float | None = None) -> bool:
+        """Block until an event arrives (or timeout); drain pending events."""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return False
+        while True:
+            try:
+                if not os.read(self.fd, 65536):
+                    break
+            except BlockingIOError:
+                break
+        return True
+
+    def close(self):
+        os.close(self.fd)
+
+
+class SourceWatcher:
+    """Report changes in a directory tree since the last mark()."""
+
+    def __init__(self, path: str, debounce: float = 0.5):
+        """Watch path, with inotify if available, otherwise by polling."""
+        self.log = get_logger("Watcher")
+        self.path = path
+        self.debounce = debounce
+        self.snapshot = {}
+        try:
+            self.inotify = _Inotify()
+            self.inotify.add_tree(path)
+            self.backend = "inotify"
+        except (AttributeError, OSError) as error:
+            self.log.debug(f"[WATCHER] INOTIFY_UNAVAILABLE reason={error}")
+            self.inotify = None
+            self.backend = "poll"
+        self.log.debug(f"[WATCHER] START path={path} backend={self.backend} debounce={debounce}")
+
+    def mark(self):
+        """Take the reference snapshot (call it right before a build)."""
+        self.snapshot = take_snapshot(self.path)
+
+    def _diff(self, current: dict) -> list:
+        changed = {path for path, stat in current.items() if self.snapshot.get(path) != stat}
+        changed.update(path for path in self.snapshot if path not in current)
+        return sorted(changed)
+
+    def _block(self):
+        """Sleep until something may have changed."""
+        if self.inotify is not None:
+            self.inotify.wait(timeout=None)
+        else:
+            time.sleep(POLL_INTERVAL)
+
+    def wait(self) -> list:
+        """Block until the tree differs from the last mark() and settles.
+
+        Return the relative paths that were added, modified or deleted.
+        Changes made while the previous build was running are reported
+        immediately.
+        """
+        while True:
+            current = take_snapshot(self.path)
+            changed = self._diff(current)
+            if changed:
+                # Debounce: wait until two snapshots in a row are equal
+                while True:
+                    time.sleep(self.debounce)
+                    if self.inotify is not None:
+                        self.inotify.wait(timeout=0)
+                    settled = take_snapshot(self.path)
+                    if settled == current:
+                        break
+                    current = settled
+                changed = self._diff(current)
+                if changed:
+                    if self.inotify is not None:
+                        # Watch directories created in the meantime
+                        try:
+                            self.inotify.add_tree(self.path)
+                        except OSError as error:
+                            self.log.warning(f"[WATCHER] INOTIFY_FAIL reason={error} fallback=poll")
+                            self.close()
+                    self.log.debug(f"[WATCHER] CHANGES n={len(changed)}")
+                    return changed
+            self._block()
+
+    def close(self):
+        """Release the inotify descriptor."""
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None
@@ -186,40 +186,13 @@ class Theme(Builder):
         TPL_PAGE_EVENTS_DAYS = self.template('EVENTCAL_PAGE_EVENTS_DAYS')
         TPL_PAGE_EVENTS_MONTHS = self.template('EVENTCAL_PAGE_EVENTS_MONTHS')
         SORT = "Date"
-        # Get events dates
-        for docId in doclist:
-            props = self.srvdtb.get_doc_properties(docId)
-            timestamp = self.srvdtb.get_doc_timestamp(docId)
-            if timestamp is None:
-                continue
-            # Build dict of events for a given date as a list of tuples
-            # (month, day) indexed by year
-            # Also, build a dict to store those docs ocurring in that date
-            try:
-                timestamp = guess_datetime(timestamp)
-                y = timestamp.year
-                m = timestamp.month
-                d = timestamp.day
-                self.dey.setdefault(y, []).append((m, d))
-
-                # Build dict of documents
-                if not y in self.events_docs:
-                    self.events_docs[y] = {}
-
-                if not m in self.events_docs[y]:
-                    self.events_docs[y][m] = {}
-
-                if not d in self.events_docs[y][m]:
-                    self.events_docs[y][m][d] = []
-
-                docs = self.events_docs[y][m][d]
-                docs.append(docId)
-                self.events_docs[y][m][d] = docs
-            except Exception as error:
-                # Doc doesn't have a valid date field. Skip it.
-                self.log.error(f"[THEME] DATE_INVALID doc={os.path.basename(docId)} timestamp={timestamp}")
-                self.log.error(f"[THEME] ERROR {error}")
-                raise
+        # Bucket events by year/month/day using the database calendar
+        # index. dey keeps a (month, day) tuple per document, by year
+        self.events_docs = self.srvdtb.get_calendar(doclist)
+        for y, months in self.events_docs.items():
+            for m, days in months.items():
+                for d, docs in days.items():
+                    self.dey.setdefault(y, []).extend([(m, d)] * len(docs))
 
         kbdict = self.srvbes.get_kb_dict()
         base_var = self.get_theme_var()
@@ -570,7 +543,7 @@ class Theme(Builder):
             toc = '\n'.join(items)
         return toc
 
-    def build_page(self, path_md, var={}):
+    def build_page(self, path_md, var={}, *, source_html=None, source_md=None):
         """Build the final HTML Page.
 
         At this point, the Markdown compilation has finished successfully,
@@ -583,11 +556,14 @@ class Theme(Builder):
         transformations in the body.
 
         Finally, the html page produced by the compiler is overwritten.
+        The compiler passes the fragment and the source in memory
+        (source_html, source_md); otherwise they are read from disk.
         """
         path_hdoc = html_id_for(path_md)
         basename_md = os.path.basename(path_md)
         basename_hdoc = os.path.basename(path_hdoc)
-        exists_hdoc = os.path.exists(path_hdoc)  # it should be true
+        # it should be true
+        exists_hdoc = source_html is not None or os.path.exists(path_hdoc)
         repo = self.srvbes.get_dict('repo')
         try:
             strict = repo['strict']
@@ -632,11 +608,13 @@ class Theme(Builder):
         timestamp = get_human_datetime(now)
         keys = self.srvdtb.get_doc_properties(basename_md)
 
-        with open(path_md, 'r') as fpa:
-            source_md = fpa.read()
+        if source_md is None:
+            with open(path_md, 'r') as fpa:
+                source_md = fpa.read()
 
-        with open(path_hdoc, 'r') as fph:
-            source_html = fph.read()
+        if source_html is None:
+            with open(path_hdoc, 'r') as fph:
+                source_html = fph.read()
 
         var['toc'] = self.extract_toc(source_html)
         var['has_toc'] = True
@@ -695,7 +673,7 @@ class Theme(Builder):
         HTML += FOOTER
 
         with open(path_hdoc, 'w') as fhtml:
-            fhtml.write(HTML)
+            fhtml.write(self.serialize_html(HTML))
 
     def build_page_key(self, key, values):
         """Create page for a key."""
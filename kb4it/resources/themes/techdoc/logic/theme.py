@@ -17,7 +17,6 @@ import os
 from calendar import monthrange
 from collections import Counter
 from datetime import datetime, timedelta
-from lxml import etree
 
 from kb4it.core.util import (ellipsize_text, get_day, get_font_size,
                              get_human_datetime, get_human_datetime_day,
@@ -26,8 +25,6 @@ from kb4it.core.util import (ellipsize_text, get_day, get_font_size,
                              set_max_frequency, source_ext, valid_filename)
 from kb4it.services.builder import Builder
 
-parser = etree.HTMLParser()
-
 class Theme(Builder):
     dey = {}
     events_docs = {}
@@ -280,26 +277,25 @@ class Theme(Builder):
         month_ago = datetime(month_ago_year, month_ago_month, month_ago_day)
 
         rows = []
-        for year in sorted(self.events_docs.keys()):
-            for month in sorted(self.events_docs[year].keys()):
-                for day in sorted(self.events_docs[year][month].keys()):
-                    d = datetime(year, month, day)
-                    if d < month_ago or d > yesterday:
-                        continue
-                    for docId in self.events_docs[year][month][day]:
-                        props = self.srvdtb.get_doc_properties(docId)
-                        title = props.get('Title', docId)
-                        if isinstance(title, list):
-                            title = title[0] if title else docId
-                        url = props.get('Title_Url', html_id_for(docId))
-                        categories = self.srvdtb.get_values(docId, 'Category')
-                        category = categories[0] if categories and categories[0] else ''
-                        rows.append({
-                            'date': d.strftime('%b %d'),
-                            'title': title,
-                            'url': url,
-                            'category': category,
-                        })
+        for year, month, day in self.srvdtb.get_days_in_range(month_ago, yesterday):
+            docs = self.events_docs.get(year, {}).get(month, {}).get(day, [])
+            if not docs:
+                continue
+            d = datetime(year, month, day)
+            for docId in docs:
+                props = self.srvdtb.get_doc_properties(docId)
+                title = props.get('Title', docId)
+                if isinstance(title, list):
+                    title = title[0] if title else docId
+                url = props.get('Title_Url', html_id_for(docId))
+                categories = self.srvdtb.get_values(docId, 'Category')
+                category = categories[0] if categories and categories[0] else ''
+                rows.append({
+                    'date': d.strftime('%b %d'),
+                    'title': title,
+                    'url': url,
+                    'category': category,
+                })
         rows.reverse()
         return rows
 
@@ -398,41 +394,13 @@ class Theme(Builder):
         TPL_PAGE_EVENTS_DAYS = self.template('EVENTCAL_PAGE_EVENTS_DAYS')
         TPL_PAGE_EVENTS_MONTHS = self.template('EVENTCAL_PAGE_EVENTS_MONTHS')
         SORT = "Date"
-        # Get events dates
-        for docId in doclist:
-            props = self.srvdtb.get_doc_properties(docId)
-            timestamp = self.srvdtb.get_doc_timestamp(docId)
-            if timestamp is None:
-                continue
-            # Build dict of events for a given date as a list of tuples
-            # (month, day) indexed by year
-            # Also, build a dict to store those docs ocurring in that date
-            try:
-                timestamp = guess_datetime(timestamp)
-                y = timestamp.year
-                m = timestamp.month
-                d = timestamp.day
-                self.dey.setdefault(y, []).append((m, d))
-
-                # Build dict of documents
-                if not y in self.events_docs:
-                    self.events_docs[y] = {}
-
-                if not m in self.events_docs[y]:
-                    self.events_docs[y][m] = {}
-
-                if not d in self.events_docs[y][m]:
-                    self.events_docs[y][m][d] = []
-
-                docs = self.events_docs[y][m][d]
-                docs.append(docId)
-                self.events_docs[y][m][d] = docs
-            except Exception as error:
-                # Doc doesn't have a valid date field. Skip it.
-                self.log.error(f"[THEME] DATE_INVALID doc={os.path.basename(docId)} timestamp={timestamp}")
-                self.log.error(f"[THEME] ERROR {error}")
-
-                raise
+        # Bucket events by year/month/day using the database calendar
+        # index. dey keeps a (month, day) tuple per document, by year
+        self.events_docs = self.srvdtb.get_calendar(doclist)
+        for y, months in self.events_docs.items():
+            for m, days in months.items():
+                for d, docs in days.items():
+                    self.dey.setdefault(y, []).extend([(m, d)] * len(docs))
 
         kbdict = self.srvbes.get_kb_dict()
         base_var = self.get_theme_var()
@@ -790,7 +758,7 @@ class Theme(Builder):
             toc = '\n'.join(items)
         return toc
 
-    def build_page(self, path_md):
+    def build_page(self, path_md, *, source_html=None, source_md=None):
         """Build the final HTML Page.
 
         At this point, the Markdown compilation has finished successfully and
@@ -802,11 +770,14 @@ class Theme(Builder):
         transformations in the body.
 
         Finally, the html page produced by the compiler is overwritten.
+        The compiler passes the fragment and the source in memory
+        (source_html, source_md); otherwise they are read from disk.
         """
         path_hdoc = html_id_for(path_md)
         basename_md = os.path.basename(path_md)
         basename_hdoc = os.path.basename(path_hdoc)
-        exists_hdoc = os.path.exists(path_hdoc)  # it should be true
+        # it should be true
+        exists_hdoc = source_html is not None or os.path.exists(path_hdoc)
 
         if not exists_hdoc:
             self.log.error(f"[THEME] HTML_MISSING doc={basename_md}")
@@ -819,11 +790,13 @@ class Theme(Builder):
             timestamp = get_human_datetime(now)
             keys = self.srvdtb.get_doc_properties(basename_md)
 
-            with open(path_md, 'r') as fpa:
-                source_md = fpa.read()
+            if source_md is None:
+                with open(path_md, 'r') as fpa:
+                    source_md = fpa.read()
 
-            with open(path_hdoc, 'r') as fph:
-                source_html = fph.read()
+            if source_html is None:
+                with open(path_hdoc, 'r') as fph:
+                    source_html = fph.read()
 
             var['toc'] = self.extract_toc(source_html)
             var['has_toc'] = True
@@ -868,9 +841,7 @@ class Theme(Builder):
             HTML += FOOTER
 
             with open(path_hdoc, 'w') as fhtml:
-                tree = etree.fromstring(HTML, parser)
-                pretty_html = etree.tostring(tree, pretty_print=True, method="html").decode()
-                fhtml.write(f"<!DOCTYPE html>\n{pretty_html}")
+                fhtml.write(self.serialize_html(HTML, default="pretty"))
 
     def build_page_key(self, key, values):
         """Create page for a key."""
@@ -21,6 +21,7 @@ from kb4it.core.env import ENV
 from kb4it.core.exceptions import ConfigError, KB4ITError, ThemeError
 from kb4it.core.log import redirect_logs
 from kb4it.core.service import Service
+from kb4it.core.store import KBStore
 from kb4it.core.util import (get_hash_from_content, get_hash_from_file,
                              get_source_docs, json_load, json_save, timeit)
 from kb4it.services.compiler import Compiler
@@ -36,7 +37,7 @@ class Backend(Service):
         self.runtime: Runtime = {"theme": {}}  # type: ignore[typeddict-item]
         self.params = self.app.get_params()  # Get params from command line
 
-        if self.params.get("action") in ("build", "info"):
+        if self.params.get("action") in ("build", "info", "watch"):
             config_file = self.params.get("config")
             if config_file is None:
                 raise ConfigError("No config file specified")
@@ -75,12 +76,14 @@ class Backend(Service):
             dir_cache = Path.joinpath(dir_var, "cache")
             dir_www = Path.joinpath(dir_var, "www")
             dir_db = Path.joinpath(dir_var, "db")
+            dir_fragments = Path.joinpath(dir_var, "fragments")
 
             self.runtime["dir"]["tmp"] = dir_tmp
             self.runtime["dir"]["www"] = dir_www
             self.runtime["dir"]["cache"] = dir_cache
             self.runtime["dir"]["log"] = dir_log
             self.runtime["dir"]["db"] = dir_db
+            self.runtime["dir"]["fragments"] = dir_fragments
 
             if self.params.get("force"):
                 shutil.rmtree(dir_var, ignore_errors=True)
@@ -102,7 +105,9 @@ class Backend(Service):
             if os.path.exists(app_log_file):
                 os.unlink(app_log_file)
             kb4it_temp_log = self.app.get_log_file()
-            shutil.copy(kb4it_temp_log, app_log_file)
+            # A build daemon only has a temporary log for its first instance
+            if os.path.exists(kb4it_temp_log):
+                shutil.copy(kb4it_temp_log, app_log_file)
             redirect_logs(app_log_file)
 
             # Initialize docs structure
@@ -194,12 +199,27 @@ class Backend(Service):
         """Get path by name."""
         return self.runtime.get("dir", {}).get(name)
 
+    def get_store(self) -> KBStore | None:
+        """Return the SQLite build database, if enabled in repo.json."""
+        if self.get_value("repo", "database") != "sqlite":
+            return None
+        if getattr(self, "store", None) is None:
+            kb4it_dbfile = os.path.join(self.get_path("db"), "kbdict.sqlite")
+            self.store = KBStore(kb4it_dbfile)
+        return self.store
+
     def load_kbdict(self):
         """Load KB4IT dictionary."""
         kb4it_dbfile = os.path.join(self.get_path("db"), "kbdict.json")
         empty_kbdict = {"document": {}, "metadata": {}}
         try:
-            kbdict = json_load(kb4it_dbfile)
+            store = self.get_store()
+            if store is not None and not store.is_empty():
+                kb4it_dbfile = store.path
+                kbdict = store.load()
+            else:
+                # An empty store imports the previous JSON build once
+                kbdict = json_load(kb4it_dbfile)
             self.log.debug(f"[BACKEND] KBDICT_LOAD path={kb4it_dbfile}")
             stored_version = kbdict.get("kb4it_version")
             current_version = ENV["APP"]["version"]
@@ -218,11 +238,45 @@ class Backend(Service):
         return kbdict
 
     def save_kbdict(self, kbdict):
-        """Save kb4it dictionary."""
+        """Save kb4it dictionary.
+
+        With the SQLite store only changed rows are written; kbdict.json
+        is still exported (when something changed) for the TUI Explorer.
+        """
         kb4it_dbfile = os.path.join(self.get_path("db"), "kbdict.json")
         kbdict["kb4it_version"] = ENV["APP"]["version"]
-        json_save(kb4it_dbfile, kbdict)
-        self.log.debug(f"[BACKEND] KBDICT_SAVED path={kb4it_dbfile}")
+        store = self.get_store()
+        if store is None:
+            json_save(kb4it_dbfile, kbdict)
+            self.log.debug(f"[BACKEND] KBDICT_SAVED path={kb4it_dbfile}")
+            return
+
+        changed = store.save(kbdict)
+        store.close()
+        self.store = None
+        self.log.debug(f"[BACKEND] KBDICT_SAVED path={store.path} changed={changed}")
+        if changed or not os.path.exists(kb4it_dbfile):
+            json_save(kb4it_dbfile, kbdict)
+            self.log.debug(f"[BACKEND] KBDICT_EXPORTED path={kb4it_dbfile}")
+
+    def reset_build(self):
+        """Prepare services for another build in the same process.
+
+        Used by watch mode and the build daemon: the Database is emptied,
+        the Processor keeps the previous build as reference and only the
+        first build honours --force. Loaded themes and compiled templates
+        are kept. The repository log is rotated, as in a new process.
+        """
+        app_log_file = self.runtime["logfile"]
+        if app_log_file.exists():
+            shutil.copy2(app_log_file, app_log_file.with_suffix('.log.old'))
+            os.unlink(app_log_file)
+        redirect_logs(app_log_file)
+        self.params["force"] = False
+        self.runtime["docs"] = {"count": 0, "bag": [], "targets": set()}
+        self.get_service("DB").reset()
+        self.srvprc.reset()
+        self.log.debug("[BACKEND] BUILD_RESET")
 
     def add_target(self, aid, hid):
         """Add documents to be compiled."""
@@ -7,17 +7,21 @@ Builder service.
 # License: GPL v3
 """
 
+import hashlib
 import os
-import shutil
 import threading
 from datetime import datetime
 
+from lxml import etree
 from mako.template import Template
 
 from kb4it.core.env import ENV
 from kb4it.core.exceptions import ThemeError
+from kb4it.core.mdext import THEMED_SENTINEL
 from kb4it.core.service import Service
-from kb4it.core.util import get_human_datetime, html_id_for, valid_filename
+from kb4it.core.util import (compile_replacements, get_hash_from_list,
+                             get_human_datetime, html_id_for, minify_html,
+                             valid_filename)
 
 
 REQUIRED_TEMPLATES = [
@@ -27,6 +31,14 @@ REQUIRED_TEMPLATES = [
     "PAGE_KEY_VALUE",
 ]
 
+HTML_OUTPUT_MODES = ("raw", "pretty", "minified")
+
+# Repository settings shown in the header of every page
+CHROME_REPO_KEYS = (
+    "title", "tagline", "logo", "logo_alt",
+    "git", "git_server", "git_user", "git_repo", "git_branch", "git_path",
+)
+
 
 def _template_candidates(template_name, theme_templates_dir, global_templates_dir):
     return [
@@ -35,14 +47,22 @@ def _template_candidates(template_name, theme_templates_dir, global_templates_di
     ]
 
 
+def template_cache_dir(theme_id):
+    """Return the compiled templates cache directory for a theme."""
+    return os.path.join(ENV["LPATH"]["TEMPLATES"], theme_id)
+
+
 class Builder(Service):
     """Build HTML blocks."""
 
     theme_var = {}
+    # Class-level caches, shared by all Builder instances (and processes
+    # serving several repositories), keyed by theme templates directory
     templates = {}
     _templates_lock = threading.Lock()
     _xform_lock = threading.Lock()
-    _xform_pairs = None
+    _xformers = {}
+    _html_output_warned = set()
 
     _XFORM_NAMES = [
         'HTML_TAG_A', 'HTML_TAG_TOC',
@@ -75,18 +95,57 @@ class Builder(Service):
         Markdown compile pipeline; target (_NEW) templates supply theme-
         specific replacements.
         """
-        if Builder._xform_pairs is None:
+        if content.startswith(THEMED_SENTINEL):
+            # Already themed by the Markdown extension at compile time
+            return content.removeprefix(f"{THEMED_SENTINEL}\n")
+        _, transform = self.get_transformations()
+        return transform(content)
+
+    def get_transformations(self):
+        """Return the theme transformation pairs and the function applying them."""
+        theme_templates = self.srvbes.get_dict("theme")["templates"]
+        xform = Builder._xformers.get(theme_templates)
+        if xform is None:
             with self._xform_lock:
-                if Builder._xform_pairs is None:
-                    Builder._xform_pairs = [
+                xform = Builder._xformers.get(theme_templates)
+                if xform is None:
+                    pairs = [
                         (self.render_template(f'{n}_MD'),
                          self.render_template(f'{n}_NEW'))
                         for n in self._XFORM_NAMES
                     ]
-        for old, new in Builder._xform_pairs:
-            if old:
-                content = content.replace(old, new)
-        return content
+                    xform = (pairs, compile_replacements(pairs))
+                    Builder._xformers[theme_templates] = xform
+        return xform
+
+    def get_html_output(self, default: str = "raw") -> str:
+        """Return the HTML output mode set in repo.json ('html_output')."""
+        mode = self.srvbes.get_value("repo", "html_output") or default
+        if mode not in HTML_OUTPUT_MODES:
+            if mode not in self._html_output_warned:
+                self._html_output_warned.add(mode)
+                self.log.warning(f"[BUILDER] HTML_OUTPUT_INVALID value={mode} using={default}")
+            mode = default
+        return mode
+
+    def serialize_html(self, html: str, default: str = "raw") -> str:
+        """Return a finished page as set by the 'html_output' repo option.
+
+        - raw: as rendered by the templates
+        - pretty: reparsed and indented (a full lxml DOM per page)
+        - minified: insignificant whitespace, comments and optional end
+          tags removed, without building a tree
+
+        Themes pass the mode used when the repository does not set one.
+        """
+        mode = self.get_html_output(default)
+        if mode == "pretty":
+            # lxml parsers must not be shared between threads
+            tree = etree.fromstring(html, etree.HTMLParser())
+            return "<!DOCTYPE html>\n" + etree.tostring(tree, pretty_print=True, method="html").decode()
+        if mode == "minified":
+            return minify_html(html)
+        return html
 
     def generate_sources(self):
         """Generate sources.
@@ -101,8 +160,10 @@ class Builder(Service):
         """
 
     def distribute_html(self, mdId, htmlId):
-        """Add compiled page to the target list."""
-        shutil.copy(htmlId, self.srvbes.get_path("www"))
+        """Add a page built by a previous build to the target list.
+
+        The page stays in the cache and is deployed from there.
+        """
         self.srvbes.add_target(mdId, os.path.basename(htmlId))
 
     def distribute_md(self, name, content, as_html=True):
@@ -131,23 +192,24 @@ class Builder(Service):
     def template(self, template):
         """Return Mako Template object."""
         runtime = self.srvbes.get_dict("runtime")
-        cached = self.templates.get(template)
+        theme = runtime["theme"]
+        cache_key = (theme["templates"], template)
+        cached = self.templates.get(cache_key)
         if cached is not None:
             return cached
 
         with self._templates_lock:
-            cached = self.templates.get(template)
+            cached = self.templates.get(cache_key)
             if cached is not None:
                 return cached
 
-            theme = runtime["theme"]
             candidates = _template_candidates(
                 template, theme["templates"], ENV["GPATH"]["TEMPLATES"]
             )
             for template_path in candidates:
                 try:
-                    tpl = Template(filename=template_path)
-                    self.templates[template] = tpl
+                    tpl = self._load_template(template_path, theme)
+                    self.templates[cache_key] = tpl
                     self.log.debug(f"[BUILDER] TEMPLATE_CANDIDATE_FOUND path={template_path}")
                     return tpl
                 except Exception as err:
@@ -157,6 +219,25 @@ class Builder(Service):
             self.log.error(f"[BUILDER] TEMPLATE_NOT_FOUND name={template}")
             raise ThemeError(f"Template not found: {template}")
 
+    def _load_template(self, template_path, theme):
+        """Load a template, using the compiled module cache if possible.
+
+        Compiled modules are stored in ENV['LPATH']['TEMPLATES']/<theme id>
+        and named after the template and a hash of its path and content,
+        so an edited template never reuses a stale module.
+        """
+        with open(template_path, "rb") as ftpl:
+            digest = hashlib.sha1(template_path.encode("utf-8") + b"\0" + ftpl.read()).hexdigest()[:16]
+        theme_id = theme.get("id") or os.path.basename(theme["path"])
+        name = os.path.splitext(os.path.basename(template_path))[0]
+        module_filename = os.path.join(template_cache_dir(theme_id), f"{name}.{digest}.py")
+        try:
+            return Template(filename=template_path, module_filename=module_filename)
+        except OSError as error:
+            # Cache not writable: compile in memory
+            self.log.debug(f"[BUILDER] TEMPLATE_CACHE_SKIP path={module_filename} reason={error}")
+            return Template(filename=template_path)
+
     def render_template(self, name, var=None):
         """Render template according to dict var values."""
         if var is None:
@@ -177,19 +258,38 @@ class Builder(Service):
         theme_var["kb"]["keys"] = self.srvdtb.get_keys()
         theme_var["count_docs"] = self.srvdtb.get_documents_count()
         theme_var["repo"]["updated"] = get_human_datetime(datetime.now())
+        theme_var["kb"]["keys"]["menu"] = self.get_menu_keys()
+        return theme_var
 
-        # Only pass to theme those keys used by documents
+    def get_menu_keys(self):
+        """Return the navigation menu entries.
+
+        Only keys used by documents are passed to the theme.
+        """
         kbdict = self.srvbes.get_kb_dict()
-        metadata = kbdict["metadata"]
+        used_keys = set(kbdict["metadata"].keys())
         ignored_keys = set(self.srvdtb.get_ignored_keys())
         blocked_keys = set(self.srvdtb.get_blocked_keys())
-        used_keys = set(metadata.keys())
-        theme_var["kb"]["keys"]["menu"] = sorted(
+        return sorted(
             [{"name": k, "href": valid_filename(k)} for k in (used_keys - blocked_keys - ignored_keys)],
             key=lambda d: d["name"],
         )
 
-        return theme_var
+    def get_chrome_hash(self):
+        """Return a hash of the page chrome.
+
+        The chrome is what every page shows around its content: the
+        navigation menu, the document count and the repository title,
+        logo and git settings. When it changes, every page must be
+        rebuilt, even if no document did.
+        """
+        repo = self.srvbes.get_dict("repo")
+        chrome = [
+            [entry["name"] for entry in self.get_menu_keys()],
+            self.srvdtb.get_documents_count(),
+            [repo.get(key) for key in CHROME_REPO_KEYS],
+        ]
+        return get_hash_from_list(chrome)
 
     def page_hook_pre(self, var):
         """Insert html code before the content.
@@ -208,18 +308,21 @@ class Builder(Service):
     def build_page_key(self, key, values):
         """Create page for a key."""
 
-    def build_page(self, path_md):
+    def build_page(self, path_md, *, source_html=None, source_md=None):
         """Build the final HTML Page for a document.
 
         At this point, the Markdown document has been compiled successfully,
         and therefore the html page can be built. The Builder receives the
-        source document filepath; another file with extension .html should
-        also exist. The html page is built by inserting the html header at
-        the beginning, appending the footer at the end, and applying the
-        necessary transformations.
-
-        Finally, the html page produced by the compiler is overwritten.
-        This method must be overwritten by custom themes.
+        source document filepath and, from the compiler, the compiled
+        fragment (source_html) and the document source (source_md), so
+        neither has to be read back from disk. The html page is built by
+        inserting the html header at the beginning, appending the footer
+        at the end, and applying the necessary transformations, and then
+        written to the .html file next to the source.
+
+        This method must be overwritten by custom themes. Themes whose
+        build_page() does not accept source_html get the fragment written
+        to the .html file first, and read it from there.
         """
 
     def build_page_key_value(self, kvpath):
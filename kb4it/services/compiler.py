@@ -8,18 +8,37 @@ Service Compiler.
 # Description: Markdown-to-HTML compiler service
 """
 
+import inspect
 import os
 import re
-import shutil
 import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from concurrent.futures import ThreadPoolExecutor as Executor
+from concurrent.futures.process import BrokenProcessPool
 
 import markdown as _markdown_lib
 
 from kb4it.core.env import ENV
+from kb4it.core.fragments import FragmentCache
+from kb4it.core.mdext import THEMED_SENTINEL, ThemeExtension, ThemeRules
 from kb4it.core.service import Service
-from kb4it.core.util import (get_default_workers, get_source_docs,
-                              html_id_for, source_ext)
+from kb4it.services.builder import Builder
+from kb4it.core.util import (compile_replacements, get_default_workers,
+                             get_hash_from_list, get_source_docs, html_id_for,
+                             source_ext)
+
+COMPILER_BACKENDS = ("thread", "process")
+MD_EXTENSIONS = ["extra", "admonition", "toc", "sane_lists"]
+
+# The first H1 heading is the title, already shown in the page header
+_TITLE_HEADING_RE = re.compile(r"^#\s+[^\n]+\n?")
+
+# Below this number of documents, starting worker processes (each one
+# setting up its own Markdown instance) costs more than it saves.
+COMPILE_POOL_MIN_DOCS = 32
+
+# Markdown instance of a compiler worker process (see _init_worker)
+_worker_md = None
 
 # Optional TUI callbacks set by kb4it.tui.app before a build, cleared after.
 # _progress_callback: called per document,  signature: (basename: str, rc: bool)
@@ -61,133 +80,285 @@ class Compiler(Service):
         self.srvthm = self.get_service("Theme")
         self.srvprc = self.get_service("Processor")
 
+    def get_backend(self) -> str:
+        """Return the compiler backend set in repo.json ('compiler_backend')."""
+        backend = self.srvbes.get_value("repo", "compiler_backend") or "thread"
+        if backend not in COMPILER_BACKENDS:
+            self.log.warning(f"[COMPILER] BACKEND_INVALID value={backend} using=thread")
+            backend = "thread"
+        return backend
+
     def execute(self):
         """Compile Markdown documents to HTML."""
         self.log.debug("[COMPILER] START")
 
-        # copy online resources to target path
-        resources_dir_tmp = os.path.join(self.srvbes.get_path("tmp"), "resources")
-
-        # if path already exists, remove it before copying with copytree()
-        if os.path.exists(resources_dir_tmp):
-            shutil.rmtree(resources_dir_tmp)
-            shutil.copytree(ENV["GPATH"]["RESOURCES"], resources_dir_tmp)
-        self.log.debug("[COMPILER] RESOURCES_COPIED")
-
         distributed = self.srvbes.get_value("docs", "targets")
         targets_count = len(distributed) if distributed else 0
         self.log.debug(f"[COMPILER] TARGETS count={targets_count}")
         max_workers = self.srvbes.get_value("repo", "workers")
         if max_workers is None:
             max_workers = get_default_workers()
-        self.log.debug(f"[COMPILER] WORKERS n={max_workers}")
-        with Executor(max_workers=max_workers) as exe:
-            docs = sorted(get_source_docs(self.srvbes.get_path("tmp")))
-            if _compile_start_callback is not None:
-                try:
-                    _compile_start_callback(len(docs))
-                except Exception as err:
-                    self.log.debug(f"[COMPILER] CALLBACK_ERROR stage=start err={err}")
-            jobs = []
-            num = 1
-            tmp_dir = self.srvbes.get_path("tmp")
-
-            for doc in docs:
-                basename = os.path.basename(doc)
-                fmt = source_ext(basename)
-                data = {
-                    "doc": doc,
-                    "format": fmt,
-                    "tmp_dir": tmp_dir,
-                    "num": num,
-                }
-                self.log.debug(f"[COMPILER] QUEUE doc={basename} format={fmt}")
-                job = exe.submit(self._compile_md, data)
-                job.add_done_callback(self.compilation_finished)
-                jobs.append(job)
-                num += 1
-
-            if num - 1 > 0:
-                self.log.debug("[COMPILER] COMPILATION_START")
-                for job in jobs:
-                    job.result()
-                self.log.debug(f"[COMPILER] COMPILED n={num - 1}")
+        backend = self.get_backend()
+        self.log.debug(f"[COMPILER] WORKERS n={max_workers} backend={backend}")
+        pairs, self.transform = self.srvthm.get_transformations()
+        self.theme_rules = ThemeRules.from_pairs(pairs)
+        if self.theme_rules is None:
+            self.log.debug("[COMPILER] THEME_RULES disabled=yes reason=non_tag_patterns")
+        # One Markdown instance per compiler thread, reused for every document
+        self._local = threading.local()
+        self.in_memory = _renders_in_memory(self.srvthm)
+        if not self.in_memory:
+            self.log.debug("[COMPILER] IN_MEMORY disabled=yes reason=build_page_signature")
+        fingerprint = get_hash_from_list([
+            ENV["APP"]["version"],
+            _markdown_lib.__version__,
+            MD_EXTENSIONS,
+            pairs if self.theme_rules is not None else None,
+        ])
+        self.fragments = FragmentCache(self.srvbes.get_path("fragments"), fingerprint)
+
+        docs = sorted(get_source_docs(self.srvbes.get_path("tmp")))
+        if _compile_start_callback is not None:
+            try:
+                _compile_start_callback(len(docs))
+            except Exception as err:
+                self.log.debug(f"[COMPILER] CALLBACK_ERROR stage=start err={err}")
+        jobs = []
+        for num, doc in enumerate(docs, start=1):
+            basename = os.path.basename(doc)
+            fmt = source_ext(basename)
+            data = {
+                "doc": doc,
+                "format": fmt,
+                "num": num,
+            }
+            # Source documents were already read and split during
+            # extraction; reuse their body instead of re-reading it.
+            document = self.srvprc.get_document(basename)
+            if document is not None and document.body is not None:
+                data["text"] = strip_title_heading(document.body)
+                data["content"] = document.content
+                data["key"] = self.fragments.key(data["text"])
+            self.log.debug(f"[COMPILER] QUEUE doc={basename} format={fmt}")
+            jobs.append(data)
+
+        if jobs:
+            self.log.debug("[COMPILER] COMPILATION_START")
+            if backend == "process":
+                pending = self._compile_in_processes(jobs, max_workers, pairs)
             else:
-                self.log.debug("[COMPILER] NOTHING_TO_COMPILE")
-            self.log.debug("[COMPILER] END")
+                pending = jobs
+            if pending:
+                with Executor(max_workers=max_workers) as exe:
+                    futures = []
+                    for data in pending:
+                        future = exe.submit(self._compile_md, data)
+                        future.add_done_callback(self.compilation_finished)
+                        futures.append(future)
+                    for future in futures:
+                        future.result()
+            self.log.debug(f"[COMPILER] COMPILED n={len(jobs)} cached={self.fragments.hits}")
+        else:
+            self.log.debug("[COMPILER] NOTHING_TO_COMPILE")
+        self.fragments.prune(self.srvprc.get_kb_dict()["document"])
+        self.log.debug("[COMPILER] END")
+
+    def _compile_in_processes(self, jobs: list, max_workers: int, pairs: list) -> list:
+        """Compile documents in chunks on a process pool.
+
+        Each worker process keeps one Markdown instance for all its
+        documents. Pages are built in this process as chunks come back.
+        Return the jobs left to the thread backend: documents with a
+        cached fragment, or everything if the pool is not worth it or
+        could not be used.
+        """
+        cached = []
+        to_compile = []
+        for data in jobs:
+            if "key" in data and self.fragments.has(data["key"]):
+                cached.append(data)
+            else:
+                to_compile.append(data)
+        if len(to_compile) < COMPILE_POOL_MIN_DOCS:
+            return jobs
+        chunksize = max(1, len(to_compile) // (max_workers * 4))
+        chunks = [to_compile[i:i + chunksize] for i in range(0, len(to_compile), chunksize)]
+        self.log.debug(f"[COMPILER] COMPILE_POOL workers={max_workers} chunks={len(chunks)} chunksize={chunksize}")
+        pending = {None: to_compile}
+        try:
+            with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker, initargs=(pairs,)) as exe:
+                # The source stays here, workers only need the text
+                pending = {
+                    exe.submit(_compile_chunk, [{k: v for k, v in data.items() if k != "content"} for data in chunk]): chunk
+                    for chunk in chunks
+                }
+                for future in as_completed(list(pending)):
+                    for data, result in zip(pending[future], future.result()):
+                        if result[1] and "key" in data:
+                            self.fragments.put(os.path.basename(data["doc"]), data["key"], result[4])
+                        self.page_compiled(self._compiled(data, result))
+                    del pending[future]
+        except (BrokenProcessPool, OSError) as error:
+            self.log.warning(f"[COMPILER] COMPILE_POOL_FAIL reason={error} fallback=thread")
+        return cached + [data for chunk in pending.values() for data in chunk]
 
     def _compile_md(self, data):
-        """Compile a Markdown file in-process via python-markdown.
+        """Compile a Markdown file with this thread's Markdown instance."""
+        fragment = self._cached_fragment(data)
+        if fragment is not None:
+            return self._compiled(data, (data["doc"], True, data["num"], None, fragment, None))
+        md = getattr(self._local, "md", None)
+        if md is None:
+            md = self._local.md = new_markdown(self.theme_rules, self.transform)
+        result = compile_document(md, data)
+        if result[1] and "key" in data:
+            self.fragments.put(os.path.basename(data["doc"]), data["key"], result[4])
+        return self._compiled(data, result)
+
+    def _cached_fragment(self, data):
+        """Return the stored fragment of a document, or None."""
+        if "key" not in data:
+            return None
+        basename = os.path.basename(data["doc"])
+        fragment = self.fragments.get(basename, data["key"])
+        if fragment is not None:
+            self.log.debug(f"[COMPILER] FRAGMENT_HIT doc={basename}")
+        return fragment
+
+    def _compiled(self, data, result):
+        """Return (doc, rc, num, fragment, source) for page_compiled()."""
+        doc, rc, num, error, html_fragment, source = result
+        if error is not None:
+            self.log.error(f"[COMPILER] MD_COMPILE_FAIL doc={os.path.basename(doc)} error={error}")
+        if source is None:
+            source = data.get("content")
+        return doc, rc, num, html_fragment, source
+
+    def compilation_finished(self, future):
+        """Once compiled, build page."""
+        return self.page_compiled(future.result())
+
+    def page_compiled(self, result):
+        """Build the page of a compiled document.
 
-        Files tagged by Builder.distribute_md() with the theme-html sentinel
-        contain pre-rendered HTML and are passed through verbatim,  section
-        restructuring would corrupt their UIKit layout.
+        The fragment and the source are handed to build_page() in memory,
+        so the page is written once. Themes that do not take them get the
+        fragment written to the .html file first.
         """
-        doc = data["doc"]
-        num = data["num"]
-        tmp_dir = data["tmp_dir"]
-        try:
+        path_hdoc, rc, num, html_fragment, source = result
+        basename = os.path.basename(path_hdoc)
+        self.log.info(f"[COMPILER] COMPILED doc={basename} rc={rc}")
+        if _progress_callback is not None:
+            try:
+                _progress_callback(basename, rc)
+            except Exception as err:
+                self.log.debug(f"[COMPILER] CALLBACK_ERROR stage=progress err={err}")
+        if rc is True:
+            try:
+                if self.in_memory:
+                    self.srvthm.build_page(path_hdoc, source_html=html_fragment, source_md=source)
+                else:
+                    with open(html_id_for(path_hdoc), "w", encoding="utf-8") as fh:
+                        fh.write(html_fragment)
+                    self.srvthm.build_page(path_hdoc)
+            except MemoryError:
+                self.log.error("[COMPILER] MEMORY_EXHAUSTED")
+                self.log.error("[COMPILER] HINT use fewer workers or add memory")
+            except Exception as error:
+                self.log.error(f"[COMPILER] ERROR {error}")
+                self.print_traceback()
+        else:
+            self.log.error(f"[COMPILER] COMPILE_FAILED doc={basename}")
+        return result
+
+
+def new_markdown(rules=None, transform=None):
+    """Return a Markdown instance set up for KB4IT documents.
+
+    When theme rules are given, the instance builds the TOC, sections
+    and theme markup while converting (see kb4it.core.mdext). Instances
+    are reused: render_markdown() resets them before each document.
+    """
+    extensions = list(MD_EXTENSIONS)
+    if rules is not None:
+        extensions.append(ThemeExtension(rules=rules, transform=transform))
+    return _markdown_lib.Markdown(extensions=extensions)
+
+
+def strip_title_heading(body: str) -> str:
+    """Return a document body without its title (first H1 heading)."""
+    return _TITLE_HEADING_RE.sub("", body, count=1)
+
+
+def render_markdown(md, text: str) -> str:
+    """Convert a document body (without frontmatter and title) to an HTML fragment."""
+    md.reset()
+    html_fragment = md.convert(text)
+    if "kb4it_theme" in md.treeprocessors and md.treeprocessors["kb4it_theme"].themed:
+        # TOC, sections and theme markup were built in the tree
+        return f"{THEMED_SENTINEL}\n{html_fragment}"
+    # Inject a TOC block so extract_toc() can populate the Contents nav menu.
+    toc_block = _md_toc_block(md.toc)
+    if toc_block:
+        html_fragment = toc_block + '\n' + html_fragment
+    # Restructure flat headings into sect1/sectionbody divs so the
+    # transformation pipeline produces the UIKit accordion layout.
+    return _restructure_md_sections(html_fragment)
+
+
+def compile_document(md, data: dict):
+    """Compile a document to its HTML fragment, in memory.
+
+    Files tagged by Builder.distribute_md() with the theme-html sentinel
+    contain pre-rendered HTML and are passed through verbatim,  section
+    restructuring would corrupt their UIKit layout.
+
+    Return (doc, rc, num, error, fragment, source); source is the file
+    content if it had to be read (None if the text came with the job).
+    Errors are returned rather than logged, since this runs in worker
+    processes too.
+    """
+    doc = data["doc"]
+    num = data["num"]
+    source = None
+    try:
+        text = data.get("text")
+        if text is None:
             with open(doc, "r", encoding="utf-8") as fh:
-                text = fh.read()
-            out_path = os.path.join(tmp_dir, html_id_for(os.path.basename(doc)))
+                text = source = fh.read()
 
             if text.startswith("<!-- kb4it:theme-html -->"):
                 _, _, html_fragment = text.partition("-->")
-                with open(out_path, "w", encoding="utf-8") as fh:
-                    fh.write(html_fragment.lstrip("\n"))
-                return doc, True, num
+                return doc, True, num, None, html_fragment.lstrip("\n"), source
 
             # Strip YAML frontmatter
             if text.startswith("---"):
                 end = text.find("\n---", 3)
                 if end >= 0:
                     text = text[end + 4:].lstrip("\n")
-            # Strip the first H1 heading,  the title is already shown in the page header
-            text = re.sub(r"^#\s+[^\n]+\n?", "", text, count=1)
-            md = _markdown_lib.Markdown(
-                extensions=["extra", "admonition", "toc", "sane_lists"],
-            )
-            html_fragment = md.convert(text)
-            # Inject a TOC block so extract_toc() can populate the Contents nav menu.
-            toc_block = _md_toc_block(md.toc)
-            if toc_block:
-                html_fragment = toc_block + '\n' + html_fragment
-            # Restructure flat headings into sect1/sectionbody divs so the
-            # transformation pipeline produces the UIKit accordion layout.
-            html_fragment = _restructure_md_sections(html_fragment)
-            with open(out_path, "w", encoding="utf-8") as fh:
-                fh.write(html_fragment)
-            return doc, True, num
-        except Exception as err:
-            self.log.error(f"[COMPILER] MD_COMPILE_FAIL doc={os.path.basename(doc)} error={err}")
-            return doc, False, num
+            text = strip_title_heading(text)
+        return doc, True, num, None, render_markdown(md, text), source
+    except Exception as err:
+        return doc, False, num, str(err), None, source
 
-    def compilation_finished(self, future):
-        """Once compiled, build page."""
-        cur_thread = threading.current_thread().name
-        x = future.result()
-        if cur_thread != x:
-            path_hdoc, rc, num = x
-            basename = os.path.basename(path_hdoc)
-            self.log.info(f"[COMPILER] COMPILED doc={basename} rc={rc}")
-            if _progress_callback is not None:
-                try:
-                    _progress_callback(basename, rc)
-                except Exception as err:
-                    self.log.debug(f"[COMPILER] CALLBACK_ERROR stage=progress err={err}")
-            if rc is True:
-                try:
-                    self.srvthm.build_page(path_hdoc)
-                except MemoryError:
-                    self.log.error("[COMPILER] MEMORY_EXHAUSTED")
-                    self.log.error("[COMPILER] HINT use fewer workers or add memory")
-                except Exception as error:
-                    self.log.error(f"[COMPILER] ERROR {error}")
-                    self.print_traceback()
-                return x
-            else:
-                self.log.error(f"[COMPILER] COMPILE_FAILED doc={basename}")
-                return x
+
+def _renders_in_memory(theme) -> bool:
+    """Return True if the theme's build_page() takes the compiled fragment."""
+    build_page = type(theme).build_page
+    if build_page is Builder.build_page:
+        return False
+    return "source_html" in inspect.signature(build_page).parameters
+
+
+def _init_worker(pairs):
+    """Set up the Markdown instance of a compiler worker process."""
+    global _worker_md
+    _worker_md = new_markdown(ThemeRules.from_pairs(pairs), compile_replacements(pairs))
+
+
+def _compile_chunk(chunk: list) -> list:
+    """Compile a chunk of documents in a worker process."""
+    return [compile_document(_worker_md, data) for data in chunk]
 
 
 def _md_toc_block(toc_html: str) -> str:
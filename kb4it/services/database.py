@@ -7,27 +7,36 @@
 
 from __future__ import annotations
 
+from bisect import bisect_left, bisect_right
+from operator import itemgetter
 from typing import TYPE_CHECKING
 
 if TYPE_CHECKING:
     from kb4it.core.types import DBRecord
 
 from kb4it.core.service import Service
-from kb4it.core.util import (get_hash_from_list, guess_datetime, html_id_for,
-                             sort_dictionary, valid_filename)
+from kb4it.core.util import guess_datetime, html_id_for, valid_filename
 
 
 class Database(Service):
     """KB4IT database class."""
 
     db = {}
+    index = {}
     keys = {}
     keys_doc = {}
     sorted_docs = []
+    chronology = None
+    timeline = []
+    timestamps = []
+    range_timeline = []
+    range_timestamps = []
+    calendar = {}
+    calendar_days = []
+    doc_day = {}
     cache_props = {}
     cache_docs_by_kvpath = {}
     cache_keys_by_doc = {}
-    cache_docs_sorted_by_date = {}
     cache_all_values_for_key = {}
 
     def _initialize(self):
@@ -35,6 +44,8 @@ class Database(Service):
         self.srvbes = self.get_service("Backend")
         repo = self.srvbes.get_dict("repo")
         self.db: dict[str, DBRecord] = {}
+        # Inverted index: key -> value -> docIds (dict used as ordered set)
+        self.index: dict[str, dict[str, dict[str, None]]] = {}
         self.keys = {
             "all": [],
             "blocked": ["Title", "SystemPage", "Date"],
@@ -44,20 +55,27 @@ class Database(Service):
         }
         self.keys_doc = {}
         self.sorted_docs = []
+        self.chronology = None
         self.cache_props = {}
         self.cache_docs_by_kvpath = {}
         self.cache_keys_by_doc = {}
-        self.cache_docs_sorted_by_date = {}
         self.cache_all_values_for_key = {}
         self.ignore_key("Title")
 
+    def reset(self):
+        """Empty the database before another build in the same process."""
+        self._initialize()
+
     def del_document(self, docId):
         """Delete a document node from database."""
         key = f"{docId}.md"
         try:
-            del self.db[key]
+            record = self.db.pop(key)
+            for dkey, values in record.items():
+                for value in values:
+                    self._unindex(key, dkey, value)
             self.sorted_docs = []
-            self.cache_docs_sorted_by_date = {}
+            self.chronology = None
             self.log.debug("[DATABASE] DOC_DELETE doc=%s", docId)
             self.sort_database()
         except KeyError:
@@ -65,6 +83,12 @@ class Database(Service):
 
     def add_document(self, docId: str):
         """Add a new document node to the database ('name.md')."""
+        previous = self.db.get(docId, {})
+        for key, values in previous.items():
+            for value in values:
+                self._unindex(docId, key, value)
+        if "Date" in previous or "SystemPage" in previous:
+            self.chronology = None
         self.db[docId] = {}
         self.log.debug("[DATABASE] DOC_ADD doc=%s", docId)
 
@@ -77,8 +101,31 @@ class Database(Service):
         except KeyError:
             self.db[docId][key] = [value]
 
+        values = self.index.setdefault(key, {})
+        if value not in values:
+            values[value] = {}
+            self.cache_all_values_for_key.pop(key, None)
+        values[value][docId] = None
+        self.cache_docs_by_kvpath.pop(f"{key}-{value}", None)
+        if key in ("Date", "SystemPage"):
+            self.chronology = None
+
         self.log.debug("[DATABASE] KV_ADD doc=%s key=%s value=%s", docId, key, value)
 
+    def _unindex(self, docId, key, value):
+        """Remove a document from the inverted index entry key/value."""
+        try:
+            docs = self.index[key][value]
+        except KeyError:
+            return
+        docs.pop(docId, None)
+        if not docs:
+            del self.index[key][value]
+            if not self.index[key]:
+                del self.index[key]
+            self.cache_all_values_for_key.pop(key, None)
+        self.cache_docs_by_kvpath.pop(f"{key}-{value}", None)
+
     def get_blocked_keys(self):
         """Return blocked keys."""
         return self.keys["blocked"]
@@ -99,24 +146,87 @@ class Database(Service):
         if len(self.sorted_docs) == 0:
             self.sorted_docs = self.sort_by_date(list(self.db.keys()))
 
+    def _build_chronology(self):
+        """Build the global chronological order of dated documents.
+
+        Documents are ordered by timestamp desc, then by docId, and
+        each one gets its position in that timeline, so ties are broken
+        here once. Built once per build and invalidated only when a
+        document's Date or system status changes.
+        """
+        dated = []
+        system_dated = []
+        for docId in self.db:
+            if self.is_system(docId):
+                # Left out of the timeline, but found by date range
+                sdate = self.get_doc_timestamp(docId)
+                dt = guess_datetime(sdate) if sdate is not None else None
+                if dt is not None:
+                    system_dated.append((dt, docId))
+                continue
+            sdate = self.get_doc_timestamp(docId)
+            if sdate is None:
+                self.log.warning(f"[DATABASE] DATE_INVALID doc={docId} value={sdate}")
+                continue
+            dt = guess_datetime(sdate)
+            if dt is None:
+                self.log.warning(f"[DATABASE] DATE_INVALID doc={docId} value={sdate}")
+                continue
+            dated.append((dt, docId))
+        dated.sort(key=itemgetter(1))
+        dated.sort(key=itemgetter(0), reverse=True)
+
+        positions = {}
+        calendar = {}
+        doc_day = {}
+        for position, (dt, docId) in enumerate(dated):
+            positions[docId] = position
+            doc_day[docId] = (dt.year, dt.month, dt.day)
+            calendar.setdefault(dt.year, {}).setdefault(dt.month, {}).setdefault(dt.day, []).append(docId)
+
+        # Ascending views for binary search; timeline stays newest first
+        self.timeline = [docId for _, docId in dated]
+        self.timestamps = [dt for dt, _ in reversed(dated)]
+        if system_dated:
+            everything = sorted(dated + system_dated, key=itemgetter(1))
+            everything.sort(key=itemgetter(0), reverse=True)
+            self.range_timeline = [docId for _, docId in everything]
+            self.range_timestamps = [dt for dt, _ in reversed(everything)]
+        else:
+            self.range_timeline = self.timeline
+            self.range_timestamps = self.timestamps
+        self.calendar = calendar
+        self.calendar_days = sorted(set(doc_day.values()))
+        self.doc_day = doc_day
+        self.chronology = positions
+        self.log.debug(f"[DATABASE] CHRONOLOGY_BUILT docs={len(positions)} days={len(self.calendar_days)}")
+        return positions
+
+    def get_chronology(self) -> dict:
+        """Return docId -> position in the timeline (0 is the most recent)."""
+        if self.chronology is None:
+            return self._build_chronology()
+        return self.chronology
+
     def sort_by_date(self, doclist=None):
-        """Build a list of documents sorted by timestamp desc."""
+        """Build a list of documents sorted by timestamp desc.
+
+        The documents are selected from the precomputed timeline, in its
+        order, so nothing is parsed or sorted here. Documents sharing a
+        timestamp are ordered by docId, whatever their order in doclist.
+        """
+        positions = self.get_chronology()
         if doclist is None or len(doclist) == 0:
-            doclist = list(self.db.keys())
-        list_hash = get_hash_from_list(sorted(doclist))
-        if list_hash not in self.cache_docs_sorted_by_date:
-            adict = {}
-            for docId in doclist:
-                if not self.is_system(docId):
-                    sdate = self.get_doc_timestamp(docId)
-                    if sdate is None:
-                        self.log.warning(f"[DATABASE] DATE_INVALID doc={docId} value={sdate}")
-                        continue
-                    dt = guess_datetime(sdate)
-                    adict[docId] = dt  # .strftime("%Y%m%d")
-            sorted_docs = [docId for docId, _ in sort_dictionary(adict)]
-            self.cache_docs_sorted_by_date[list_hash] = sorted_docs
-        return self.cache_docs_sorted_by_date[list_hash]
+            doclist = self.db.keys()
+        wanted = set()
+        for docId in dict.fromkeys(doclist):
+            if docId in positions:
+                wanted.add(docId)
+            elif not self.is_system(docId):
+                self.log.warning(f"[DATABASE] DATE_INVALID doc={docId} value={self.get_doc_timestamp(docId)}")
+        if len(wanted) == len(positions):
+            return list(self.timeline)
+        return [docId for docId in self.timeline if docId in wanted]
 
     def get_documents(self):
         """Return the list of sorted docs."""
@@ -186,13 +296,7 @@ class Database(Service):
         try:
             return self.cache_all_values_for_key[key]
         except KeyError:
-            values = []
-            for docId in self.db:
-                try:
-                    values.extend(self.db[docId][key])
-                except KeyError:
-                    pass
-            values = list(set(values))
+            values = list(self.index.get(key, {}))
             values.sort(key=lambda y: y.lower())
             self.cache_all_values_for_key[key] = values
             return self.cache_all_values_for_key[key]
@@ -259,26 +363,59 @@ class Database(Service):
         kvpath = f"{key}-{value}"
         cached = kvpath in self.cache_docs_by_kvpath
         if not cached:
-            docs = []
-            for docId in self.db:
-                if key in self.db[docId]:
-                    if value in self.db[docId][key]:
-                        docs.append(docId)
+            docs = list(self.index.get(key, {}).get(value, {}))
             self.cache_docs_by_kvpath[kvpath] = self.sort_by_date(docs) if docs else []
             self.log.debug(f"[DATABASE] KV_SEARCH key={key} value={value} count={len(self.cache_docs_by_kvpath[kvpath])}")
         return self.cache_docs_by_kvpath[kvpath]
 
     def get_docs_by_date_range(self, ds, de) -> list:
-        """Return documents whose Date falls within [ds, de]."""
-        doclist = []
-        for docId in self.db:
-            ts = self.get_doc_timestamp(docId)
-            if ts is None:
+        """Return documents whose Date falls within [ds, de], newest first.
+
+        System pages with a Date are included, as they always were,
+        although they are not part of the timeline.
+        """
+        self.get_chronology()
+        total = len(self.range_timestamps)
+        lo = bisect_left(self.range_timestamps, ds)
+        hi = bisect_right(self.range_timestamps, de)
+        if lo >= hi:
+            return []
+        return self.range_timeline[total - hi:total - lo]
+
+    def get_calendar(self, doclist=None) -> dict:
+        """Return documents bucketed by year, month and day.
+
+        Without doclist the whole calendar is returned (do not modify
+        it). Otherwise only the given documents are bucketed, keeping
+        their order; undated documents are left out.
+        """
+        self.get_chronology()
+        if doclist is None:
+            return self.calendar
+        calendar = {}
+        for docId in doclist:
+            try:
+                y, m, d = self.doc_day[docId]
+            except KeyError:
                 continue
-            dt = guess_datetime(ts)
-            if dt >= ds and dt <= de:
-                doclist.append(docId)
-        return doclist
+            calendar.setdefault(y, {}).setdefault(m, {}).setdefault(d, []).append(docId)
+        return calendar
+
+    def get_days_in_range(self, ds, de) -> list:
+        """Return (year, month, day) tuples with documents within [ds, de]."""
+        self.get_chronology()
+        lo = bisect_left(self.calendar_days, (ds.year, ds.month, ds.day))
+        hi = bisect_right(self.calendar_days, (de.year, de.month, de.day))
+        return self.calendar_days[lo:hi]
+
+    def get_docs_by_month(self, year, month) -> list:
+        """Return documents dated in the given month, newest first."""
+        days = self.get_calendar().get(year, {}).get(month, {})
+        return [docId for day in days.values() for docId in day]
+
+    def get_docs_by_day(self, year, month, day) -> list:
+        """Return documents dated in the given day, newest first."""
+        return list(self.get_calendar().get(year, {}).get(month, {}).get(day, []))
 
     def get_doc_keys(self, docId):
         """Return a list of keys for a given docId sorted alphabetically."""
@@ -11,10 +11,36 @@ import glob
 import os
 import shutil
 
+from kb4it.core.assets import AssetManifest, AssetStore
+from kb4it.core.delta import DeployDelta
 from kb4it.core.env import ENV
-from kb4it.core.exceptions import ThemeError
+from kb4it.core.exceptions import DeployError, ThemeError
+from kb4it.core.precompress import Precompressor, is_compressible
 from kb4it.core.service import Service
-from kb4it.core.util import SOURCE_EXT_RE, copy_docs, copydir, delete_target_contents
+from kb4it.core.util import (DEPLOY_MODES, SOURCE_EXT_RE,
+                             delete_target_contents, get_default_workers,
+                             kb4it_timestamp, link_tree, log_timestamp,
+                             sync_file)
+
+# Release mode layout, inside the target directory
+RELEASES_DIR = "releases"
+CURRENT_LINK = "current"
+RELEASES_KEEP = 3
+
+# Default asset store, inside the target directory
+ASSET_STORE_DIR = ".kb4it-assets"
+
+
+def _release_order(name: str) -> tuple:
+    """Return the sort key of a release directory name.
+
+    Builds in the same second get a '_2', '_3'... suffix, which must
+    sort numerically ('_10' after '_9').
+    """
+    timestamp, sep, suffix = name.rpartition("_")
+    if sep and timestamp.count("_") == 1 and suffix.isdigit():
+        return (timestamp, int(suffix))
+    return (name, 1)
 
 
 class Deployer(Service):
@@ -23,6 +49,57 @@ class Deployer(Service):
     def _initialize(self):
         """Initialize deployer service."""
         self.srvbes = self.app.get_service("Backend")
+        self.deploy_mode = "copy"
+        self.dir_target = None
+        self.delta = None
+
+    def get_deploy_mode(self) -> str:
+        """Return the deploy mode set in repo.json ('deploy_mode')."""
+        mode = self.srvbes.get_value("repo", "deploy_mode") or "copy"
+        if mode not in DEPLOY_MODES:
+            self.log.warning(f"[DEPLOYER] DEPLOY_MODE_INVALID value={mode} using=copy")
+            mode = "copy"
+        return mode
+
+    def get_releases_keep(self) -> int:
+        """Return how many releases are kept in release mode ('releases_keep')."""
+        keep = self.srvbes.get_value("repo", "releases_keep")
+        if keep is None:
+            return RELEASES_KEEP
+        if not isinstance(keep, int) or isinstance(keep, bool) or keep < 1:
+            self.log.warning(f"[DEPLOYER] RELEASES_KEEP_INVALID value={keep} using={RELEASES_KEEP}")
+            return RELEASES_KEEP
+        return keep
+
+    def get_asset_store(self):
+        """Return the asset store set in repo.json ('asset_store'), or None.
+
+        true keeps it in the target directory (shared by releases); a
+        path can be shared by every repository on the host. It is not
+        used if it is on another filesystem than the target.
+        """
+        value = self.srvbes.get_value("repo", "asset_store")
+        if not value:
+            return None
+        if value is True:
+            path = os.path.join(self.srvbes.get_path("target"), ASSET_STORE_DIR)
+        else:
+            path = str(value)
+        store = AssetStore(path)
+        if not store.usable_for(self.dir_target):
+            self.log.warning(f"[DEPLOYER] ASSET_STORE_OTHER_FS path={store.path} using=none")
+            return None
+        return store
+
+    def get_site_path(self) -> str:
+        """Return the directory the web server must serve.
+
+        In release mode it is the 'current' link to the last release.
+        """
+        dir_target = self.srvbes.get_path("target")
+        if self.srvbes.get_value("repo", "release_mode"):
+            return os.path.join(dir_target, CURRENT_LINK)
+        return dir_target
 
     def execute(self):
         """Deploy website build by KB4IT."""
@@ -31,68 +108,217 @@ class Deployer(Service):
 
         source_files = glob.glob(os.path.join(self.srvbes.get_path("source"), "*.*"))
         source_docs = [f for f in source_files if SOURCE_EXT_RE.search(f)]
-        tmp_files = glob.glob(os.path.join(self.srvbes.get_path("tmp"), "*.*"))
-
-        self.step_00_copy_source_to_cache(source_files)
-        self.step_04_copy_sources_to_target(source_docs)
-        self.step_06_copy_all_to_cache(tmp_files)
-        self.step_07_copy_compiled_documents_to_target()
-        self.step_08_copy_global_resources_to_target()
-        self.step_09_copy_html_to_cache()
-        self.step_10_copy_kbdict_to_target()
+        tmp_pages = glob.glob(os.path.join(self.srvbes.get_path("tmp"), "*.html"))
+        self.deploy_mode = self.get_deploy_mode()
+        self.dir_target = self.srvbes.get_path("target")
+        self.delta = DeployDelta(kb4it_timestamp())
+        release = None
+        if self.srvbes.get_value("repo", "release_mode"):
+            release = self.prepare_release()
+            self.dir_target = release
+
+        try:
+            self.step_04_copy_sources_to_target(source_docs)
+            self.step_06_move_pages_to_cache(tmp_pages)
+            self.step_07_copy_compiled_documents_to_target()
+            self.step_08_copy_global_resources_to_target()
+            self.step_09_prune_cache()
+            self.step_10_copy_kbdict_to_target()
+            self.precompress()
+            self.save_changes()
+            if release is not None:
+                self.activate_release(release)
+        except Exception:
+            if release is not None:
+                # The site being served is left as it was
+                shutil.rmtree(release, ignore_errors=True)
+                self.log.error(f"[DEPLOYER] RELEASE_DISCARDED path={release}")
+            raise
+        if release is not None:
+            self.prune_releases(release)
         self.step_11_cleanup()
         self.log.debug("[DEPLOYER] END")
 
-    def step_00_copy_source_to_cache(self, files):
-        """Copy all from source directory to cache."""
-        copy_docs(files, self.srvbes.get_path("cache"))
+    def prepare_release(self) -> str:
+        """Create the directory of a new release and return its path.
+
+        The new release starts as a copy of the current one made of hard
+        links, so unchanged files cost nothing. Deployment steps replace
+        files instead of writing them in place, so the current release is
+        never modified.
+        """
+        dir_target = self.srvbes.get_path("target")
+        current = os.path.join(dir_target, CURRENT_LINK)
+        if os.path.exists(current) and not os.path.islink(current):
+            raise DeployError(f"{current} exists and is not a symbolic link; remove it to use release mode")
+
+        dir_releases = os.path.join(dir_target, RELEASES_DIR)
+        os.makedirs(dir_releases, exist_ok=True)
+        release_id = log_timestamp()
+        release = os.path.join(dir_releases, release_id)
+        n = 1
+        while os.path.exists(release):
+            n += 1
+            release = os.path.join(dir_releases, f"{release_id}_{n}")
+
+        if os.path.isdir(current):
+            link_tree(os.path.realpath(current), release)
+        else:
+            os.makedirs(release)
+        self.log.debug(f"[DEPLOYER] RELEASE_PREPARED path={release} seeded={os.path.isdir(current)}")
+        return release
+
+    def activate_release(self, release: str):
+        """Point the 'current' link to a release.
+
+        The link is replaced atomically: the web server sees either the
+        previous release or the new one, never a mix of both.
+        """
+        dir_target = self.srvbes.get_path("target")
+        current = os.path.join(dir_target, CURRENT_LINK)
+        tmp_link = f"{current}.{os.getpid()}.tmp"
+        os.symlink(os.path.relpath(release, dir_target), tmp_link)
+        os.replace(tmp_link, current)
+        self.log.info(f"[DEPLOYER] RELEASE_ACTIVATED release={os.path.basename(release)}")
+
+    def prune_releases(self, release: str):
+        """Delete the oldest releases, keeping 'releases_keep' of them.
+
+        Previous releases are kept for rollback: pointing the 'current'
+        link back to one of them restores it.
+        """
+        dir_releases = os.path.dirname(release)
+        releases = sorted(
+            (entry.name for entry in os.scandir(dir_releases) if entry.is_dir(follow_symlinks=False)),
+            key=_release_order,
+        )
+        for name in releases[:-self.get_releases_keep()]:
+            if name == os.path.basename(release):
+                continue
+            shutil.rmtree(os.path.join(dir_releases, name), ignore_errors=True)
+            self.log.debug(f"[DEPLOYER] RELEASE_PRUNED release={name}")
+
+    def precompress(self):
+        """Write .gz (and .br) sidecars for the files changed by this build.
+
+        Enabled by the 'precompress' repo option. When it is turned off,
+        existing sidecars are deleted so they are not served out of date.
+        """
+        workers = self.srvbes.get_value("repo", "workers") or get_default_workers()
+        compressor = Precompressor(self.dir_target, workers)
+        if not self.srvbes.get_value("repo", "precompress"):
+            if compressor.has_stamp():
+                removed = compressor.remove(compressor.scan(exclude=(RELEASES_DIR, ASSET_STORE_DIR)))
+                compressor.drop_stamp()
+                for relpath in removed:
+                    self.delta.record("deleted", relpath)
+                self.log.info(f"[DEPLOYER] PRECOMPRESS_DISABLED deleted={len(removed)}")
+            return
+
+        if compressor.is_current():
+            changes = self.delta.changes
+            changed = [path for path, status in changes.items() if status != "deleted" and is_compressible(path)]
+            deleted = [path for path, status in changes.items() if status == "deleted" and is_compressible(path)]
+            written = compressor.compress(changed)
+            removed = compressor.remove(deleted)
+        else:
+            written, removed = compressor.compress_all(exclude=(RELEASES_DIR, ASSET_STORE_DIR))
+            compressor.save_stamp()
+        for status, relpath in written:
+            self.delta.record(status, relpath)
+        for relpath in removed:
+            self.delta.record("deleted", relpath)
+        self.log.debug(f"[DEPLOYER] PRECOMPRESSED written={len(written)} deleted={len(removed)}")
+
+    def save_changes(self):
+        """Save the change manifest and export the delta bundle, if asked."""
+        self.delta.save(self.dir_target)
+        self.log.info(
+            f"[DEPLOYER] CHANGES added={self.delta.count('added')}"
+            f" modified={self.delta.count('modified')} deleted={self.delta.count('deleted')}"
+        )
+        export = self.srvbes.get_value("app", "export_delta")
+        if export:
+            self.delta.export(self.dir_target, export)
 
     def step_03_clear_target(self):
         """Clear target directory."""
-        delete_target_contents(self.srvbes.get_path("target"))
-        self.log.debug(f"[DEPLOYER] TARGET_CLEARED path={self.srvbes.get_path('target')}")
+        delete_target_contents(self.dir_target)
+        self.log.debug(f"[DEPLOYER] TARGET_CLEARED path={self.dir_target}")
 
     def step_04_copy_sources_to_target(self, files):
-        """Incrementally sync source Markdown files to target/sources/."""
-        docsdir = os.path.join(self.srvbes.get_path("target"), "sources")
+        """Incrementally sync source Markdown files to target/sources/.
+
+        Sources are edited in place by their authors, so they are never
+        hard linked: a link would publish an edit before it is built.
+        """
+        docsdir = os.path.join(self.dir_target, "sources")
         os.makedirs(docsdir, exist_ok=True)
         expected = {os.path.basename(f) for f in files}
+        mode = "reflink" if self.deploy_mode in ("link", "auto") else self.deploy_mode
         n_copied = n_deleted = 0
         for filepath in files:
             dest = os.path.join(docsdir, os.path.basename(filepath))
-            if not os.path.exists(dest) or os.path.getmtime(filepath) > os.path.getmtime(dest):
-                shutil.copy(filepath, dest)
+            existed = os.path.exists(dest)
+            if sync_file(filepath, dest, mode) != "skipped":
                 n_copied += 1
+                self.delta.record("modified" if existed else "added", f"sources/{os.path.basename(filepath)}")
         for filename in os.listdir(docsdir):
             if filename not in expected:
                 os.unlink(os.path.join(docsdir, filename))
                 n_deleted += 1
+                self.delta.record("deleted", f"sources/{filename}")
                 self.log.debug(f"[DEPLOYER] STALE_SOURCE_DELETED file={filename}")
         self.log.debug(f"[DEPLOYER] SOURCES_TO_TARGET copied={n_copied} deleted={n_deleted}")
 
-    def step_06_copy_all_to_cache(self, files):
-        """Copy objects in temporary directory to cache path."""
-        copy_docs(files, self.srvbes.get_path("cache"))
-        self.log.debug(f"[DEPLOYER] COPIED_ALL_TO_CACHE n={len(files)}")
+    def step_06_move_pages_to_cache(self, files):
+        """Move the pages built in the temporary directory to the cache.
+
+        The cache keeps the last version of every page; pages not built
+        again are deployed from there. Cache files may be hard linked to
+        target files: they are replaced, not written in place.
+        """
+        dir_cache = self.srvbes.get_path("cache")
+        for filepath in files:
+            os.replace(filepath, os.path.join(dir_cache, os.path.basename(filepath)))
+        self.log.debug(f"[DEPLOYER] MOVED_PAGES_TO_CACHE n={len(files)}")
 
     def step_07_copy_compiled_documents_to_target(self):
-        """Incrementally sync compiled HTML to target: copy expected, delete stale."""
+        """Incrementally sync compiled HTML to target: copy expected, delete stale.
+
+        Pages whose content is already in target are skipped. The others
+        are copied, hard linked or reflinked as set by 'deploy_mode'; when
+        a method is not possible, the next one is used for the rest of the
+        pages.
+        """
         runtime = self.srvbes.get_dict("runtime")
         expected = runtime["docs"]["targets"]
         dir_cache = self.srvbes.get_path("cache")
-        dir_target = self.srvbes.get_path("target")
+        dir_target = self.dir_target
+        mode = self.deploy_mode
 
-        n_copied = n_deleted = 0
+        counters = {"skipped": 0, "copied": 0, "linked": 0, "reflinked": 0}
+        n_deleted = 0
         for filename in sorted(expected):
             source = os.path.join(dir_cache, filename)
             target = os.path.join(dir_target, filename)
+            existed = os.path.exists(target)
             try:
-                shutil.copy(source, target)
-                n_copied += 1
+                action = sync_file(source, target, mode)
             except FileNotFoundError as error:
                 self.log.error(f"[DEPLOYER] ERROR {error}")
                 self.log.error("[DEPLOYER] HINT rerun with -force")
-                return
+                # A partial deployment must not be reported, or activated, as a build
+                raise DeployError(f"Compiled page {filename} is missing from the cache") from error
+            counters[action] += 1
+            if action != "skipped":
+                self.delta.record("modified" if existed else "added", filename)
+            # A method that failed once is not tried again for every page
+            method = {"reflinked": "reflink", "linked": "link", "copied": "copy"}.get(action, mode)
+            if method != mode:
+                if mode != "auto":
+                    self.log.info(f"[DEPLOYER] DEPLOY_MODE_FALLBACK mode={mode} using={method}")
+                mode = method
 
         for filename in os.listdir(dir_target):
             if not filename.endswith('.html'):
@@ -100,15 +326,19 @@ class Deployer(Service):
             if filename not in expected:
                 os.unlink(os.path.join(dir_target, filename))
                 n_deleted += 1
+                self.delta.record("deleted", filename)
                 self.log.debug(f"[DEPLOYER] STALE_HTML_DELETED file={filename}")
 
-        self.log.debug(f"[DEPLOYER] HTML_TO_TARGET copied={n_copied} deleted={n_deleted}")
+        stats = " ".join(f"{name}={n}" for name, n in counters.items())
+        self.log.debug(f"[DEPLOYER] HTML_TO_TARGET mode={mode} {stats} deleted={n_deleted}")
 
     def step_08_copy_global_resources_to_target(self):
-        """Copy global resources to target path."""
-        resources_dir_target = os.path.join(
-            self.srvbes.get_path("target"), "resources")
-        theme_target_dir = os.path.join(resources_dir_target, "themes")
+        """Sync global and local resources to target path.
+
+        Only resources added, changed or removed since the previous build
+        are touched (see AssetManifest).
+        """
+        resources_dir_target = os.path.join(self.dir_target, "resources")
         theme = self.srvbes.get_dict("theme")
         if not theme.get("id") or not theme.get("path"):
             self.log.error("[DEPLOYER] THEME_NOT_LOADED")
@@ -116,32 +346,36 @@ class Deployer(Service):
         DEFAULT_THEME = os.path.join(ENV["GPATH"]["THEMES"], "default")
         CUSTOM_THEME_ID = theme["id"]
         CUSTOM_THEME_PATH = theme["path"]
-        copydir(DEFAULT_THEME, os.path.join(theme_target_dir, "default"))
-        copydir(CUSTOM_THEME_PATH, os.path.join(
-            theme_target_dir, CUSTOM_THEME_ID))
-        copydir(ENV["GPATH"]["COMMON"], os.path.join(
-            resources_dir_target, "common"))
-        self.log.debug("[DEPLOYER] COPIED_GLOBAL_RESOURCES")
-
-        # Copy local resources to target path
-        source_resources_dir = os.path.join(
-            self.srvbes.get_path("source"), "resources")
-        if os.path.exists(source_resources_dir):
-            resources_dir_target = os.path.join(
-                self.srvbes.get_path("target"), "resources"
-            )
-            copydir(source_resources_dir, resources_dir_target)
-            self.log.debug("[DEPLOYER] COPIED_LOCAL_RESOURCES")
-
-    def step_09_copy_html_to_cache(self):
-        """Copy back all HTML files from target to cache."""
+        trees = [
+            (DEFAULT_THEME, "themes/default"),
+            (CUSTOM_THEME_PATH, f"themes/{CUSTOM_THEME_ID}"),
+            (ENV["GPATH"]["COMMON"], "common"),
+            # Local resources go last: they override global ones
+            (os.path.join(self.srvbes.get_path("source"), "resources"), ""),
+        ]
+        mode = "reflink" if self.deploy_mode in ("link", "auto") else self.deploy_mode
+        changes = []
+        store = self.get_asset_store()
+        stats = AssetManifest(resources_dir_target).sync(trees, mode, changes, store)
+        for status, relpath in changes:
+            self.delta.record(status, f"resources/{relpath}")
+        self.log.debug(f"[DEPLOYER] RESOURCES_SYNCED {' '.join(f'{k}={v}' for k, v in stats.items())}")
+
+    def step_09_prune_cache(self):
+        """Delete cached pages that are not part of the website any more."""
+        expected = self.srvbes.get_dict("runtime")["docs"]["targets"]
         dir_cache = self.srvbes.get_path("cache")
-        dir_target = self.srvbes.get_path("target")
-        delete_target_contents(dir_cache)
-        pattern = os.path.join(dir_target, "*.html")
-        html_files = glob.glob(pattern)
-        copy_docs(html_files, dir_cache)
-        self.log.debug("[DEPLOYER] COPIED_HTML_BACK_TO_CACHE")
+        n_deleted = 0
+        with os.scandir(dir_cache) as entries:
+            for entry in entries:
+                if entry.name in expected:
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    shutil.rmtree(entry.path)
+                else:
+                    os.unlink(entry.path)
+                n_deleted += 1
+        self.log.debug(f"[DEPLOYER] CACHE_PRUNED deleted={n_deleted}")
 
     def step_10_copy_kbdict_to_target(self):
         """Copy JSON database to target path."""
@@ -150,5 +384,9 @@ class Deployer(Service):
         """Cleanup temporary files."""
         delete_target_contents(self.srvbes.get_path("tmp"))
         delete_target_contents(self.srvbes.get_path("www"))
-        os.unlink(self.app.get_log_file())
+        try:
+            os.unlink(self.app.get_log_file())
+        except FileNotFoundError:
+            # Already removed by a previous build of this process (watch mode)
+            pass
         self.log.debug("[DEPLOYER] CLEANUP")
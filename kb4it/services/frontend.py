@@ -8,6 +8,8 @@ Frontend module.
 """
 
 import glob
+import hashlib
+import importlib.util
 import json
 import os
 import sys
@@ -60,6 +62,58 @@ class Frontend(Service):
             self.log.info("[FRONTEND] NO_THEMES")
         self.app.stop()
 
+    def theme_precompile(self, theme_name=None):
+        """Compile theme templates into the template module cache.
+
+        Without a theme name, all global and local themes are compiled.
+        Cached modules of templates that changed since are removed.
+        """
+        from kb4it.services.builder import template_cache_dir
+
+        if theme_name is None:
+            names = set(os.listdir(ENV["GPATH"]["THEMES"])) | set(os.listdir(ENV["LPATH"]["THEMES"]))
+        else:
+            names = {theme_name}
+        for name in sorted(names):
+            try:
+                self.theme_load(name)
+            except ThemeError as error:
+                self.log.error(f"[FRONTEND] THEME_INVALID id={name} reason={error}")
+                continue
+            theme = self.runtime["theme"]
+            if "templates" not in theme:
+                self.log.error(f"[FRONTEND] THEME_NOT_FOUND name={name}")
+                continue
+
+            # Template lookup only depends on runtime["theme"]
+            builder = self.get_service("Builder")
+            tpl_names = set()
+            for tpl_dir in (theme["templates"], ENV["GPATH"]["TEMPLATES"]):
+                if os.path.isdir(tpl_dir):
+                    tpl_names.update(os.path.splitext(f)[0] for f in os.listdir(tpl_dir) if f.endswith(".tpl"))
+            modules = set()
+            for tpl_name in sorted(tpl_names):
+                try:
+                    tpl = builder.template(tpl_name)
+                except Exception as error:
+                    self.log.warning(f"[FRONTEND] TEMPLATE_COMPILE_FAIL theme={name} name={tpl_name} reason={error}")
+                    continue
+                module_file = getattr(tpl.module, "__file__", None)
+                if module_file is not None:
+                    modules.add(os.path.splitext(os.path.basename(module_file))[0])
+
+            cache_dir = template_cache_dir(theme.get("id") or name)
+            pruned = 0
+            for dirpath in (cache_dir, os.path.join(cache_dir, "__pycache__")):
+                if not os.path.isdir(dirpath):
+                    continue
+                for filename in os.listdir(dirpath):
+                    stem = filename.split(".cpython-")[0].removesuffix(".py").removesuffix(".pyc")
+                    if stem not in modules and os.path.isfile(os.path.join(dirpath, filename)):
+                        os.unlink(os.path.join(dirpath, filename))
+                        pruned += 1
+            self.log.info(f"[FRONTEND] TEMPLATES_PRECOMPILED theme={name} count={len(modules)} pruned={pruned} path={cache_dir}")
+
     def apps_list(self, theme: str):
         """List available applications for a given theme."""
         theme_path = self.theme_search(theme)
@@ -123,10 +177,10 @@ class Frontend(Service):
 
             # Register theme service
             self.log.debug(f"[FRONTEND] THEME_REGISTER path={self.runtime['theme']['logic']}")
-            sys.path.insert(0, self.runtime["theme"]["logic"])
+            if self.runtime["theme"]["logic"] not in sys.path:
+                sys.path.insert(0, self.runtime["theme"]["logic"])
             try:
-                from theme import Theme
-
+                Theme = self._theme_class(self.runtime["theme"]["logic"])
                 self.app.register_service("Theme", Theme())
                 self.get_service("Theme")
                 self.log.debug("[FRONTEND] THEME_LOADED id=%s", self.runtime["theme"]["id"])
@@ -137,6 +191,29 @@ class Frontend(Service):
                 self.log.error(f"[FRONTEND] ERROR {error}")
                 raise ThemeError(f"Theme load failed: {error}") from error
 
+    def _theme_class(self, logic_path):
+        """Import the Theme class from a theme logic directory.
+
+        Each theme module gets its own name, so a process serving several
+        repositories can hold different themes at the same time.
+        """
+        theme_file = os.path.join(logic_path, "theme.py")
+        module_name = f"kb4it_theme_{hashlib.md5(theme_file.encode()).hexdigest()[:12]}"
+        module = sys.modules.get(module_name)
+        if module is None:
+            spec = importlib.util.spec_from_file_location(module_name, theme_file)
+            if spec is None:
+                raise ImportError(f"No theme module in {logic_path}")
+            module = importlib.util.module_from_spec(spec)
+            sys.modules[module_name] = module
+            try:
+                spec.loader.exec_module(module)
+            except BaseException:
+                del sys.modules[module_name]
+                raise
+            self.log.debug(f"[FRONTEND] THEME_MODULE name={module_name} path={theme_file}")
+        return module.Theme
+
     def _validate_required_templates(self, theme):
         """Check that all required templates exist for the loaded theme."""
         from kb4it.services.builder import REQUIRED_TEMPLATES, _template_candidates
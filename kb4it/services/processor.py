@@ -9,6 +9,8 @@ Service Processor.
 from __future__ import annotations
 
 import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from dataclasses import dataclass, field
 from typing import TYPE_CHECKING
 
@@ -16,15 +18,21 @@ if TYPE_CHECKING:
     from kb4it.core.types import KBDict
 
 from kb4it.core.service import Service
-from kb4it.core.util import (get_document_attributes, get_hash_from_body,
-                             get_hash_from_dict, html_id_for, string_timestamp,
-                             valid_filename)
+from kb4it.core.util import (ParsedDocument, dump_date_cache,
+                             get_default_workers, html_id_for,
+                             load_date_cache, parse_document,
+                             string_timestamp, valid_filename)
+
+# Below this number of sources, spawning a process pool costs more than
+# parsing the documents serially.
+EXTRACTION_POOL_MIN_DOCS = 64
 
 
 @dataclass
 class AnalysisResult:
     """Carries the outputs of step_01_analysis so they are passed explicitly."""
     force_kv_pairs: set = field(default_factory=set)
+    chrome_changed: bool = False
 
 
 @dataclass
@@ -62,6 +70,18 @@ class Processor(Service):
         self.srvdtb = self.app.get_service("DB")
         self.kbdict_cur: KBDict = self.srvbes.load_kbdict()  # Previous run
         self.kbdict_new: KBDict = {"document": {}, "metadata": {}}
+        self.documents: dict[str, ParsedDocument] = {}
+        self.plan = BuildPlan()
+
+    def reset(self):
+        """Prepare a new build in the same process (watch mode).
+
+        The kbdict built in the previous cycle becomes the reference for
+        change detection, and parsed documents are kept so unchanged
+        sources are neither read nor parsed again.
+        """
+        self.kbdict_cur = self.kbdict_new
+        self.kbdict_new = {"document": {}, "metadata": {}}
         self.plan = BuildPlan()
 
     @property
@@ -72,25 +92,130 @@ class Processor(Service):
         """Return the current BuildPlan."""
         return self.plan
 
+    def get_document(self, docId: str) -> ParsedDocument | None:
+        """Return the ingestion record of a source document (or None)."""
+        return self.documents.get(docId)
+
+    def parse_sources(self, sources: list) -> list[ParsedDocument]:
+        """Parse source documents, in parallel when worthwhile.
+
+        YAML parsing and hashing are CPU bound, so documents are spread
+        over a process pool sized by repo["workers"]. Results are
+        returned in the same order as 'sources', which keeps the merge
+        into kbdict and the Database deterministic.
+        """
+        max_workers = self.srvbes.get_value("repo", "workers")
+        if max_workers is None:
+            max_workers = get_default_workers()
+
+        if max_workers > 1 and len(sources) >= EXTRACTION_POOL_MIN_DOCS:
+            chunksize = max(1, len(sources) // (max_workers * 4))
+            self.log.debug(f"[PROCESSOR] EXTRACTION_POOL workers={max_workers} chunksize={chunksize}")
+            try:
+                with ProcessPoolExecutor(max_workers=max_workers) as exe:
+                    return list(exe.map(parse_document, sources, chunksize=chunksize))
+            except (BrokenProcessPool, OSError) as error:
+                self.log.warning(f"[PROCESSOR] EXTRACTION_POOL_FAIL reason={error} fallback=serial")
+
+        return [parse_document(filepath) for filepath in sources]
+
+    def load_sources(self, sources: list, stats: dict) -> list[ParsedDocument]:
+        """Return a ParsedDocument per source, parsing only changed files.
+
+        A source whose stat (mtime_ns, size, inode) matches the one saved
+        in the previous build is not read: its keys and hashes are taken
+        from the previous kbdict and its content is loaded later, only if
+        it has to be compiled. Forced builds and --verify-hashes parse
+        every source.
+        """
+        verify = self.srvbes.get_value("app", "force") or self.srvbes.get_value("app", "verify_hashes")
+        previous = self.kbdict_cur.get("document", {})
+        documents = {}
+        if not verify:
+            for filepath in sources:
+                entry = previous.get(os.path.basename(filepath))
+                if entry is None or entry.get("stat") != stats.get(filepath) or entry.get("content") != filepath:
+                    continue
+                document = self.documents.get(os.path.basename(filepath))
+                if document is not None and document.path == filepath:
+                    # Still in memory from the previous cycle (watch mode)
+                    documents[filepath] = document
+                    continue
+                try:
+                    keys = {key: entry["keys"][key] for key in entry.get("key_order", entry["keys"])}
+                    documents[filepath] = ParsedDocument(
+                        path=filepath,
+                        content=None,
+                        keys=keys,
+                        body=None,
+                        title=keys["Title"][0],
+                        body_hash=entry["body_hash"],
+                        metadata_hash=entry["metadata_hash"],
+                        valid=True,
+                        reason="unchanged",
+                    )
+                except (KeyError, IndexError, TypeError):
+                    continue
+
+        changed = [filepath for filepath in sources if filepath not in documents]
+        documents.update(zip(changed, self.parse_sources(changed)))
+        self.log.debug(f"[PROCESSOR] EXTRACTION reused={len(sources) - len(changed)} parsed={len(changed)}")
+        return [documents[filepath] for filepath in sources]
+
+    def load_contents(self, docIds: list) -> list[ParsedDocument]:
+        """Read the sources skipped by the stat pre-filter, when needed.
+
+        They are parsed in one batch (see parse_sources), as many pages
+        are rebuilt at once when the chrome changes. A file may have
+        changed since it was stat'ed (an editor truncates it while
+        saving): its record is then invalid.
+        """
+        missing = [docId for docId in docIds if self.documents[docId].content is None]
+        if missing:
+            loaded = self.parse_sources([self.documents[docId].path for docId in missing])
+            self.documents.update(zip(missing, loaded))
+            self.log.debug(f"[PROCESSOR] CONTENTS_LOADED n={len(missing)}")
+        return [self.documents[docId] for docId in docIds]
+
     def step_00_extraction(self):
         """Extract metadata."""
-        runtime = self.srvbes.get_dict("runtime")
         sources = self.srvbes.get_value("docs", "bag")
-        for filepath in sources:
+        stats = {}
+        for filepath in list(sources):
+            try:
+                st = os.stat(filepath)
+            except FileNotFoundError:
+                # Deleted or renamed since discovery (editors save this way)
+                self.log.info(f"[PROCESSOR] DOC_VANISHED doc={os.path.basename(filepath)}")
+                sources.remove(filepath)
+                continue
+            stats[filepath] = [st.st_mtime_ns, st.st_size, st.st_ino]
+        documents = self.load_sources(sources, stats)
+        self.documents = {}
+
+        # Dates parsed in the previous build are reused as they are
+        load_date_cache(self.kbdict_cur.get("dates", {}))
+        dates = []
+
+        for filepath, document in zip(sources, documents):
             # Get Id
             docId = os.path.basename(filepath)
 
-            # Get metadata
-            keys, valid, reason = get_document_attributes(filepath)
-            self.log.debug(f"[PROCESSOR] DOC_VALID doc={os.path.basename(filepath)} valid={valid} reason={reason}")
+            # Each document is read and parsed once; the record is
+            # reused by hashing, analysis and compilation.
+            keys = document.keys
+            self.log.debug(f"[PROCESSOR] DOC_VALID doc={docId} valid={document.valid} reason={document.reason}")
 
-            if not valid:
+            if not document.valid:
                 continue
+            self.documents[docId] = document
 
             # Add to cache
             self.kbdict_new["document"][docId] = {}
             self.kbdict_new["document"][docId]["content"] = filepath
             self.kbdict_new["document"][docId]["keys"] = keys
+            self.kbdict_new["document"][docId]["key_order"] = list(keys)
+            self.kbdict_new["document"][docId]["stat"] = stats[filepath]
 
             # Add to the in-memory database
             self.srvdtb.add_document(docId)
@@ -100,6 +225,7 @@ class Processor(Service):
                     if len(value.strip()) == 0:
                         continue
                     if key == "Date":
+                        dates.append(value)
                         value = string_timestamp(value)
                     self.srvdtb.add_document_key(docId, key, value)
 
@@ -115,10 +241,10 @@ class Processor(Service):
 
                     # And viceversa, for each key/value add to kbdict['metadata'] all documents linked
                     try:
-                        documents = self.kbdict_new["metadata"][key][value]
-                        documents.append(docId)
+                        cached_docs = self.kbdict_new["metadata"][key][value]
+                        cached_docs.append(docId)
                         self.kbdict_new["metadata"][key][value] = sorted(
-                            documents, key=lambda y: y.lower()
+                            cached_docs, key=lambda y: y.lower()
                         )
                     except KeyError:
                         if key not in self.kbdict_new["metadata"]:
@@ -132,8 +258,8 @@ class Processor(Service):
             # again. Very useful to reduce the compilation time.
 
             # Get Document Body and Metadata Hashes
-            b_hash = get_hash_from_body(filepath)
-            m_hash = get_hash_from_dict(keys)
+            b_hash = document.body_hash
+            m_hash = document.metadata_hash
             self.kbdict_new["document"][docId]["body_hash"] = b_hash
             self.kbdict_new["document"][docId]["metadata_hash"] = m_hash
             self.log.debug(f"[PROCESSOR] HASH doc={docId} body={b_hash} meta={m_hash}")
@@ -143,6 +269,8 @@ class Processor(Service):
             self.srvbes.add_target(docId, htmlId)
 
         # Save new kbdict
+        self.kbdict_new["dates"] = dump_date_cache(dates)
+        self.kbdict_new["chrome"] = self.get_service("Theme").get_chrome_hash()
         self.srvbes.save_kbdict(self.kbdict_new)
 
 
@@ -152,6 +280,17 @@ class Processor(Service):
         sources = self.srvbes.get_value("docs", "bag")
         ignored = set(self.srvdtb.get_ignored_keys())
         blocked = set(self.srvdtb.get_blocked_keys())
+
+        # Menu, document count and repository title are in every page:
+        # when they change, all pages are rebuilt. Documents are rendered
+        # again from their cached fragments, without python-markdown; the
+        # page embeds the source, so the sources are still read.
+        chrome_cur = self.kbdict_cur.get("chrome")
+        analysis.chrome_changed = self.kbdict_new["chrome"] != chrome_cur
+        if analysis.chrome_changed:
+            self.log.info(f"[PROCESSOR] CHROME_CHANGED old={chrome_cur} new={self.kbdict_new['chrome']}")
+
+        to_compile = []
         for filepath in sources:
             docId = os.path.basename(filepath)
             try:
@@ -159,16 +298,9 @@ class Processor(Service):
             except KeyError:
                 continue
 
-            result = self.step_01_00_analyze_document(docId)
+            result = self.step_01_00_analyze_document(docId, analysis.chrome_changed)
             if result['compile']:
-                # Write new source file to temporary dir for the compiler
-                self.plan.docs_to_compile.add(docId)
-                source_path = os.path.join(self.srvbes.get_path("source"), docId)
-                with open(source_path, "r", encoding="utf-8") as fh:
-                    content = fh.read()
-                target = f"{self.srvbes.get_path('tmp')}/{valid_filename(docId)}"
-                with open(target, "w", encoding="utf-8") as fout:
-                    fout.write(content)
+                to_compile.append(docId)
 
             # On metadata change, force recompile of ALL (key, value) pairs
             # this document belongs to,  datatable rows reflect metadata
@@ -184,6 +316,18 @@ class Processor(Service):
             # Save compilation status
             self.kbdict_new["document"][docId]["compile"] = result['compile']
 
+        for docId, document in zip(to_compile, self.load_contents(to_compile)):
+            if not document.valid or document.content is None:
+                # Changed since extraction; the next build picks it up
+                self.log.warning(f"[PROCESSOR] DOC_INVALID doc={docId} reason={document.reason}")
+                self.kbdict_new["document"][docId]["compile"] = False
+                continue
+            # Write new source file to temporary dir for the compiler
+            self.plan.docs_to_compile.add(docId)
+            target = f"{self.srvbes.get_path('tmp')}/{valid_filename(docId)}"
+            with open(target, "w", encoding="utf-8") as fout:
+                fout.write(document.content)
+
         self.plan.force_kv_pairs = analysis.force_kv_pairs
 
         # Decide keys compilation
@@ -194,7 +338,7 @@ class Processor(Service):
         self.log.debug(f"[PROCESSOR] KEYS_AVAILABLE count={len(available_keys)}")
         self.log.debug(f"[PROCESSOR] FORCE_KV_PAIRS count={len(analysis.force_kv_pairs)}")
         self.plan.K_PATH, self.plan.KV_PATH = self.step_01_01_decide_keys_compilation(
-            available_keys, analysis.force_kv_pairs
+            available_keys, analysis.force_kv_pairs, analysis.chrome_changed
         )
 
     def get_kb_dict(self):
@@ -241,7 +385,7 @@ class Processor(Service):
 
         return alist
 
-    def step_01_00_analyze_document(self, docId: str) -> dict:
+    def step_01_00_analyze_document(self, docId: str, chrome_changed: bool = False) -> dict:
         """Decide whether a document must be recompiled.
 
         Body, metadata and title are compared independently:
@@ -250,7 +394,8 @@ class Processor(Service):
           - titles_differ:    title changed
 
         A doc recompiles when its body, metadata or title changed, its
-        HTML isn't cached yet, or compilation is forced. Metadata changes
+        HTML isn't cached yet, the page chrome changed, or compilation is
+        forced. Metadata changes
         also trigger key/value index recompilation in
         step_01_01_decide_keys_compilation.
         """
@@ -290,14 +435,16 @@ class Processor(Service):
         NOT_CACHED = not os.path.exists(cached_document)
         result['not_cached'] = NOT_CACHED
 
-        DOC_COMPILATION = BODY_DIFFERS or METADATA_DIFFERS or TITLES_DIFFER or NOT_CACHED or FORCE_COMPILATION
+        DOC_COMPILATION = (
+            BODY_DIFFERS or METADATA_DIFFERS or TITLES_DIFFER or NOT_CACHED or chrome_changed or FORCE_COMPILATION
+        )
         result['compile'] = DOC_COMPILATION
 
-        self.log.debug(f"[PROCESSOR] ANALYZE doc={docId} body={BODY_DIFFERS} meta={METADATA_DIFFERS} title={TITLES_DIFFER} not_cached={NOT_CACHED} compile={DOC_COMPILATION}")
+        self.log.debug(f"[PROCESSOR] ANALYZE doc={docId} body={BODY_DIFFERS} meta={METADATA_DIFFERS} title={TITLES_DIFFER} not_cached={NOT_CACHED} chrome={chrome_changed} compile={DOC_COMPILATION}")
 
         return result
 
-    def step_01_01_decide_keys_compilation(self, available_keys, force_kv_pairs: set):
+    def step_01_01_decide_keys_compilation(self, available_keys, force_kv_pairs: set, chrome_changed: bool = False):
         """Decide which keys and values will be compiled.
 
         A key/value page recompiles when:
@@ -308,10 +455,11 @@ class Processor(Service):
           - its value set changed (rknew != rkold), OR
           - any of its (key, value) pages recompiles, OR
           - compilation is globally forced.
+        A change in the page chrome forces all of them.
         """
         K_PATH = []
         KV_PATH = []
-        FORCE_COMPILATION = self.srvbes.get_value("repo", "force") or False
+        FORCE_COMPILATION = self.srvbes.get_value("repo", "force") or chrome_changed
 
         for key in sorted(available_keys):
             values = self.srvdtb.get_all_values_for_key(key)
@@ -10,8 +10,12 @@ import os
 import stat
 import time
 
-from kb4it.core.service import Service
+from kb4it.core.daemon import BuildDaemon
+from kb4it.core.env import ENV
+from kb4it.core.exceptions import KB4ITError
+from kb4it.core.service import Service, get_traceback
 from kb4it.core.util import copydir, json_load
+from kb4it.core.watcher import SourceWatcher
 
 
 class Workflow(Service):
@@ -27,6 +31,12 @@ class Workflow(Service):
         frontend = self.get_service("Frontend")
         frontend.theme_list()
 
+    def precompile_themes(self, theme=None):
+        """Warm the compiled templates cache of one or all themes."""
+        self.log.info(f"[WORKFLOW] ACTION name=precompile_themes theme={theme or 'all'}")
+        frontend = self.get_service("Frontend")
+        frontend.theme_precompile(theme)
+
     def list_apps(self, theme):
         """Print all apps available for a given theme to the log."""
         self.log.debug(f"[WORKFLOW] ACTION name=list_apps theme={theme}")
@@ -118,6 +128,8 @@ class Workflow(Service):
         5. Compile Markdown documents to HTML
         6. Theme Post activities
         7. Deploy
+
+        Return the build summary.
         """
         t0 = time.perf_counter()
 
@@ -179,9 +191,59 @@ class Workflow(Service):
 
         # Report
         homepage = os.path.join(
-            os.path.abspath(backend.get_path("target")), "index.html"
+            os.path.abspath(self.get_service("Deployer").get_site_path()), "index.html"
         )
         self.log.info("[WORKFLOW] BUILD_COMPLETE")
         self.log.info(f"[WORKFLOW] URL {homepage}")
         self.log.info(f"[WORKFLOW] LOG path={backend.get_value('runtime', 'logfile')}")
         self.log.info("[WORKFLOW] END")
+        return {
+            "docs_total": docs_total,
+            "compiled": compiled,
+            "skipped": skipped,
+            "keys_compiled": keys_compiled,
+            "kv_pages_compiled": kv_compiled,
+            "elapsed": round(elapsed, 3),
+            "url": homepage,
+        }
+
+    def watch_website(self):
+        """Build the website and rebuild it whenever the sources change.
+
+        Services stay alive between builds, so each rebuild skips process
+        startup, theme loading and kbdict loading, and only reads the
+        sources changed since the previous build.
+        """
+        backend = self.get_service("Backend")
+        debounce = backend.get_value("app", "debounce") or 0.5
+        watcher = SourceWatcher(backend.get_path("source"), debounce=debounce)
+        self.log.info(f"[WORKFLOW] WATCH path={backend.get_path('source')} backend={watcher.backend}")
+        try:
+            while True:
+                watcher.mark()
+                try:
+                    self.build_website()
+                except KB4ITError as error:
+                    self.log.error(f"[WORKFLOW] WATCH_BUILD_FAIL reason={error}")
+                except Exception as error:
+                    # One broken rebuild must not end the watch session
+                    self.log.error(f"[WORKFLOW] WATCH_BUILD_FAIL reason={error}")
+                    self.log.error(f"[WORKFLOW] TRACEBACK\n{get_traceback()}")
+                self.log.info("[WORKFLOW] WATCH_WAITING")
+                changed = watcher.wait()
+                self.log.info(f"[WORKFLOW] WATCH_CHANGES n={len(changed)} files={','.join(changed[:5])}")
+                backend.reset_build()
+        except KeyboardInterrupt:
+            self.log.info("[WORKFLOW] WATCH_STOP")
+        finally:
+            watcher.close()
+
+    def serve_builds(self):
+        """Serve build requests from 'kb4it build --via-daemon' clients.
+
+        One KB4IT instance is kept per repository, so builds requested
+        through the daemon start with warm services (see watch_website).
+        """
+        socket_path = self.app.get_params().get("socket") or ENV["FILE"]["SOCKET"]
+        daemon = BuildDaemon(socket_path, app_factory=type(self.app))
+        daemon.serve()
@@ -0,0 +1,73 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+Microbenchmark for Builder.apply_transformations.
+
+Compare the sequential str.replace passes with the single-pass engine
+(kb4it.core.util.compile_replacements) on synthetic pages of growing size
+and check that both produce the same HTML.
+
+Usage: python scripts/devel/bench_transformations.py [theme] [repetitions]
+"""
+
+import os
+import sys
+import timeit
+
+from mako.template import Template
+
+from kb4it.core.env import ENV
+from kb4it.core.util import compile_replacements
+from kb4it.services.builder import Builder, _template_candidates
+
+
+def load_pairs(theme):
+    theme_templates = os.path.join(ENV["GPATH"]["THEMES"], theme, "templates")
+    pairs = []
+    for name in Builder._XFORM_NAMES:
+        rendered = []
+        for suffix in ("_MD", "_NEW"):
+            for path in _template_candidates(f"{name}{suffix}", theme_templates, ENV["GPATH"]["TEMPLATES"]):
+                if os.path.exists(path):
+                    rendered.append(Template(filename=path).render(var={}))
+                    break
+            else:
+                rendered.append("")
+        pairs.append(tuple(rendered))
+    return pairs
+
+
+def sequential(pairs, content):
+    for old, new in pairs:
+        if old:
+            content = content.replace(old, new)
+    return content
+
+
+def make_page(pairs, sections):
+    """Return a page with every pattern once per section and some text."""
+    filler = "<p>Lorem ipsum dolor sit amet, <em>consectetur</em> adipiscing elit. " * 8 + "</p>\n"
+    block = "".join(f"{old}>\n{filler}" for old, _ in pairs if old)
+    return "<html><body>\n" + block * sections + "</body></html>\n"
+
+
+def main():
+    theme = sys.argv[1] if len(sys.argv) > 1 else "techdoc"
+    number = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    pairs = load_pairs(theme)
+    transform = compile_replacements(pairs)
+    print(f"theme={theme} pairs={len(pairs)} repetitions={number}")
+    for sections in (1, 10, 100, 500):
+        page = make_page(pairs, sections)
+        assert transform(page) == sequential(pairs, page), "outputs differ"
+        t_seq = min(timeit.repeat(lambda: sequential(pairs, page), number=number, repeat=3)) / number
+        t_one = min(timeit.repeat(lambda: transform(page), number=number, repeat=3)) / number
+        print(
+            f"size={len(page) / 1024:8.1f} KiB  sequential={t_seq * 1000:8.3f} ms"
+            f"  single-pass={t_one * 1000:8.3f} ms  speedup={t_seq / t_one:5.2f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()